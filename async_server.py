@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Serves the app on an event loop, using gevent.
+
+Each request runs in a greenlet, and DB (psycopg2, made cooperative by
+psycogreen) and SMTP calls yield to the others while waiting, so a single
+process can hold thousands of concurrent (e.g. long polling) connections.
+The routes and the app are the same of manage.py/wsgi.py, which keep working.
+
+Needs gevent and psycogreen:
+
+    $ pip install gevent psycogreen
+    $ python async_server.py -p 5003
+
+Remember to size the DB pool (SQLALCHEMY_POOL_SIZE/SQLALCHEMY_MAX_OVERFLOW)
+for the concurrency you expect.
+'''
+
+# Must come before anything else is imported
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import os
+import argparse
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from tagarela.app import create_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-s', '--settings', dest='settings_folder',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'settings'),
+        help='Folder with local_settings.py and keypub.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=5003)
+    parser.add_argument('-c', '--connections', type=int, default=1000,
+                        help='Max number of concurrent connections.')
+    args = parser.parse_args()
+
+    app = create_app(args.settings_folder)
+    server = WSGIServer((args.host, args.port), app,
+                        spawn=Pool(args.connections))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Micro-benchmark of the serialization of comments.
+
+Compares comment_to_dict with its previous implementation, which built each
+URL with api.url_for, on a synthetic thread (no DB needed):
+
+    $ python benchmarks/serialize.py -n 10000
+'''
+
+from __future__ import unicode_literals  # unicode by default
+from __future__ import print_function
+import os
+import sys
+import json
+import timeit
+import argparse
+
+import arrow
+from flask import Flask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tagarela import views
+from tagarela.cutils import date_to_json
+
+
+class FakeComment(object):
+    '''Has the attributes of a Comment used by the serializers.'''
+
+    def __init__(self, id, parent_id, created):
+        self.id = id
+        self.parent_id = parent_id
+        self.text = 'Comment number %s' % id
+        self.created = created
+        self.modified = created
+        self.likes = id % 7
+        self.dislikes = id % 3
+        self.hidden = False
+
+
+def legacy_comment_to_dict(c, author_name):
+    '''comment_to_dict as it was, building the URLs for each comment.'''
+    api = views.api
+    return {
+        'id': c.id,
+        'text': c.text,
+        'author': author_name,
+        'created': date_to_json(c.created),
+        'modified': date_to_json(c.modified),
+        'upvotes': c.likes,
+        'downvotes': c.dislikes,
+        'hidden': c.hidden,
+        'url': api.url_for(views.CommentAPI, comment_id=c.id),
+        'vote_url': api.url_for(views.VoteAPI, comment_id=c.id),
+        'report_url': api.url_for(views.ReportAPI, comment_id=c.id),
+        'replies': [],
+    }
+
+
+def synthetic_thread(size, replies_ratio=0.7):
+    '''Return (comment, author_name) rows, most of them replies.'''
+    now = arrow.utcnow()
+    rows = []
+    for i in range(1, size + 1):
+        parent_id = None
+        if i > 1 and i % 10 < replies_ratio * 10:
+            parent_id = i // 2
+        rows.append((FakeComment(i, parent_id, now.replace(seconds=+i)),
+                     'author%s' % (i % 100)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--size', type=int, default=10000,
+                        help='Number of comments in the thread.')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Times to repeat each measure.')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    views.api.init_app(app)
+    rows = synthetic_thread(args.size)
+
+    results = {'size': args.size}
+    with app.test_request_context():
+        for name, function in (('legacy', legacy_comment_to_dict),
+                               ('current', views.comment_to_dict)):
+            times = timeit.repeat(
+                lambda: [function(c, author) for c, author in rows],
+                number=1, repeat=args.repeat)
+            results[name] = min(times)
+        times = timeit.repeat(lambda: views.build_comment_tree(rows),
+                              number=1, repeat=args.repeat)
+        results['current_tree'] = min(times)
+    results['speedup'] = results['legacy'] / results['current']
+    print(json.dumps(results, indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,16 @@
 # coding: utf-8
 
 import os
+import sys
+import shutil
+import tempfile
 
-from flask.ext.script import Server, Manager, Shell
+from flask.ext.script import Server, Manager, Shell, Command, Option
 
 from tagarela.app import create_app
-from tagarela.extensions import db
+from tagarela.extensions import db, thread_cache
+from tagarela import models, migrations, bulk
+from tagarela.outbox import outbox
 
 
 manager = Manager(create_app)
@@ -28,5 +33,143 @@ def initdb():
     db.drop_all()
     db.create_all()
 
+
+@manager.command
+def migrate():
+    '''Upgrade the DB to the current models (tables, columns and indexes),
+    keeping its data. Indexes are created CONCURRENTLY on Postgres.'''
+    def log(msg):
+        print(msg)
+    added = migrations.migrate(db.engine, log)
+    # Only new columns need to be filled: the others are kept up to date
+    if ('comment', 'path') in added:
+        build_paths()
+    if (('thread', 'comment_count') in added or
+            ('thread', 'last_activity') in added):
+        recount_threads()
+    if ('comment', 'score') in added:
+        recompute_scores()
+
+
+@manager.command
+def index_usage():
+    '''Show how much each index is used (Postgres only).'''
+    print('%-10s %-36s %12s %14s %10s' % (
+        'table', 'index', 'scans', 'tuples read', 'size'))
+    for row in migrations.index_usage(db.engine):
+        print('%-10s %-36s %12s %14s %10s' % tuple(row))
+
+
+@manager.command
+def recount_votes():
+    '''Rebuild the likes/dislikes counters from the votes table.'''
+    models.recount_votes()
+    db.session.commit()
+    # Cached threads have the old counters
+    for thread_name, in db.session.query(models.Thread.name):
+        thread_cache.invalidate(thread_name)
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=10000, help='Comments updated per transaction.')
+def recompute_scores(batch_size=10000):
+    '''Recompute the scores of all comments (e.g. after changing the
+    formula), a range of ids at a time.'''
+    last_id = db.session.query(db.func.max(models.Comment.id)).scalar() or 0
+    for first_id in range(1, last_id + 1, batch_size):
+        models.recompute_scores(id_range=(first_id, first_id + batch_size))
+        db.session.commit()
+
+
+@manager.command
+def recount_threads(batch_size=10000):
+    '''Rebuild the comment counters and last activity of the threads, a
+    range of ids at a time.'''
+    last_id = db.session.query(db.func.max(models.Thread.id)).scalar() or 0
+    for first_id in range(1, last_id + 1, batch_size):
+        models.recount_threads(id_range=(first_id, first_id + batch_size))
+        db.session.commit()
+
+
+@manager.option('-r', '--rebuild', dest='rebuild', action='store_true',
+                help='Recompute all paths, not only the missing ones.')
+def build_paths(rebuild=False):
+    '''Set the materialized paths of the comments (needed after upgrades).'''
+    models.build_paths(rebuild)
+    db.session.commit()
+
+
+@manager.option('ids', metavar='id', type=int, nargs='+',
+                help='Ids of the comments.')
+def delete_comments(ids):
+    '''Delete (or hide, if they have replies) many comments at once.'''
+    thread_names = (db.session.query(models.Thread.name)
+                    .join(models.Comment)
+                    .filter(models.Comment.id.in_(ids))
+                    .distinct().all())
+    deleted = models.delete_comments(ids)
+    db.session.commit()
+    for thread_name, in thread_names:
+        thread_cache.invalidate(thread_name)
+    print('Deleted: %s' % ', '.join(str(i) for i in deleted))
+
+
+class Export(Command):
+    '''Export all comments and votes as NDJSON.'''
+
+    option_list = (
+        Option('path', nargs='?', default='-',
+               help='Output file (default: stdout).'),
+    )
+
+    def run(self, path):
+        out = sys.stdout if path == '-' else open(path, 'w')
+        try:
+            count = bulk.write_ndjson(bulk.export_records(), out)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        sys.stderr.write('Exported %d records\n' % count)
+
+
+class Import(Command):
+    '''Import comments and votes from NDJSON (see tagarela/bulk.py), e.g.
+    from an export. Comments get new ids.'''
+
+    option_list = (
+        Option('path', nargs='?', default='-',
+               help='Input file (default: stdin).'),
+        Option('-b', '--batch-size', dest='batch_size', type=int,
+               default=1000, help='Records inserted per transaction.'),
+    )
+
+    def run(self, path, batch_size):
+        if path == '-':
+            # Read twice: for the ids to reserve and for the import
+            lines = tempfile.TemporaryFile('w+')
+            shutil.copyfileobj(sys.stdin, lines)
+            lines.seek(0)
+        else:
+            lines = open(path)
+        try:
+            max_id = bulk.max_comment_id(bulk.read_ndjson(lines))
+            lines.seek(0)
+            comments, votes = bulk.import_records(
+                bulk.read_ndjson(lines), max_id, batch_size,
+                log=lambda msg: sys.stderr.write(msg + '\n'))
+        finally:
+            lines.close()
+        print('Imported %d comments and %d votes' % (comments, votes))
+
+
+manager.add_command('export', Export())
+manager.add_command('import', Import())
+
+
+@manager.command
+def send_reports():
+    '''Send the report e-mails that are due.'''
+    outbox.send_due(limit=None)
+
 if __name__ == '__main__':
     manager.run()
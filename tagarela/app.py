@@ -9,8 +9,13 @@ from flask.ext.restplus import apidoc
 from flask.ext.mail import Mail
 from itsdangerous import URLSafeTimedSerializer
 
-from extensions import db, sv
+from extensions import (db, sv, thread_cache, token_cache, replica,
+                        tune_engine)
 from views import api
+from votebuffer import vote_buffer
+from events import events
+from outbox import outbox
+from instrumentation import instrumentation
 
 
 def create_app(settings_folder):
@@ -25,9 +30,25 @@ def create_app(settings_folder):
 
     # DB
     db.init_app(app)
+    tune_engine(db.get_engine(app), app.config)
+    replica.init_app(app)
+
+    # Measures of requests (only used if INSTRUMENTATION is set)
+    instrumentation.init_app(app)
+
+    # Cache for rendered threads
+    thread_cache.init_app(app)
+
+    # Buffered votes (only used if VOTE_BUFFER is set)
+    vote_buffer.init_app(app)
+
+    # Server-Sent Events of threads
+    events.init_app(app)
 
     # Signer/Verifier
     sv.config(pub_key_path=os.path.join(settings_folder, 'keypub'))
+    token_cache.maxsize = app.config.get('TOKEN_CACHE_SIZE', 10000)
+    token_cache.ttl = app.config.get('TOKEN_CACHE_TTL', 300)
 
     # API
     api.init_app(app)
@@ -36,6 +57,7 @@ def create_app(settings_folder):
 
     # Mail
     api.mail = Mail(app)
+    outbox.init_app(app, api.mail)
 
     api.urltoken = URLSafeTimedSerializer(app.config['SECRET_KEY'])
 
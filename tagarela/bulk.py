@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Export and import of comments and votes as NDJSON (one JSON object per
+line), streamed in batches, so memory doesn't grow with the number of rows.
+
+Records:
+    {"type": "comment", "id": 1, "thread": "name", "author": "name",
+     "text": "...", "created": "<ISO 8601>", "modified": "<ISO 8601>",
+     "parent_id": null, "hidden": false}
+    {"type": "vote", "comment_id": 1, "author": "name", "like": true}
+
+Parents must come before their replies and comments before their votes.
+'''
+
+from __future__ import unicode_literals  # unicode by default
+import json
+from itertools import islice
+
+import arrow
+from sqlalchemy import select, func
+
+from extensions import db, thread_cache
+from models import (Comment, Thread, Author, Vote, build_paths,
+                    recount_votes, recount_threads)
+
+
+def export_records():
+    '''Yield all comments (by id) and then all votes as records.'''
+    comments = Comment.__table__
+    threads = Thread.__table__
+    authors = Author.__table__
+    votes = Vote.__table__
+
+    query = (select([comments.c.id, threads.c.name, authors.c.name,
+                     comments.c.text, comments.c.created,
+                     comments.c.modified, comments.c.parent_id,
+                     comments.c.hidden])
+             .select_from(comments.join(threads).join(authors))
+             .order_by(comments.c.id))
+    for row in stream(query):
+        (comment_id, thread_name, author_name, text, created, modified,
+         parent_id, hidden) = row
+        yield {
+            'type': 'comment',
+            'id': comment_id,
+            'thread': thread_name,
+            'author': author_name,
+            'text': text,
+            'created': created.isoformat(),
+            'modified': modified.isoformat(),
+            'parent_id': parent_id,
+            'hidden': bool(hidden),
+        }
+
+    query = (select([votes.c.comment_id, authors.c.name, votes.c.like])
+             .select_from(votes.join(authors))
+             .order_by(votes.c.comment_id))
+    for comment_id, author_name, like in stream(query):
+        yield {
+            'type': 'vote',
+            'comment_id': comment_id,
+            'author': author_name,
+            'like': like,
+        }
+
+
+def stream(query):
+    '''Execute a query, fetching rows as they are consumed (with a server
+    side cursor, where supported).'''
+    return db.session.execute(query.execution_options(stream_results=True))
+
+
+def write_ndjson(records, out):
+    '''Write records to a file, one per line.'''
+    count = 0
+    for record in records:
+        out.write(json.dumps(record) + '\n')
+        count += 1
+    return count
+
+
+def read_ndjson(lines):
+    '''Yield the records of lines of NDJSON, skipping blank lines.'''
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise ValueError('Line %d: %s' % (number, e))
+
+
+def chunks(iterable, size):
+    '''Yield lists of up to size items of iterable.'''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def resolve_names(model, names):
+    '''Return a dict of name -> id for the Author or Thread names, adding the
+    missing ones with a single insert. Doesn't commit.'''
+    names = set(names)
+    if not names:
+        return {}
+    ids = dict(db.session.query(model.name, model.id)
+               .filter(model.name.in_(names)))
+    missing = names.difference(ids)
+    if missing:
+        db.session.execute(model.__table__.insert(),
+                           [{'name': name} for name in missing])
+        ids.update(db.session.query(model.name, model.id)
+                   .filter(model.name.in_(missing)))
+    return ids
+
+
+def max_comment_id(records):
+    '''Return the greatest id of the comment records (0 if none).'''
+    max_id = 0
+    for r in records:
+        if r['type'] == 'comment':
+            max_id = max(max_id, r['id'])
+    return max_id
+
+
+def reserve_comment_ids(count):
+    '''Reserve count ids after the greatest comment id in the DB and return
+    it, the offset of the reserved range. On Postgres the sequence of the
+    ids is moved past the range before any comment is imported, so the ones
+    added meanwhile don't take them. SQLite has no sequence: don't add
+    comments while importing. Commits.'''
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        # Holds off new comments until the sequence is moved
+        db.session.execute('LOCK TABLE comment IN EXCLUSIVE MODE')
+    offset = db.session.query(func.max(Comment.id)).scalar() or 0
+    if connection.dialect.name == 'postgresql' and count > 0:
+        db.session.execute(
+            "SELECT setval(pg_get_serial_sequence('comment', 'id'), :last)",
+            {'last': offset + count})
+    db.session.commit()
+    return offset
+
+
+def import_records(records, max_id, batch_size=1000, log=None):
+    '''Bulk insert comment and vote records, a batch (and a transaction) at
+    a time. max_id is the greatest id of the comment records (see
+    max_comment_id): the ids are shifted into a range reserved for them
+    after the greatest id in the DB, keeping parent_id references valid
+    without an id map. Paths, counters and thread activity are recomputed at
+    the end, only for the imported comments and their threads, a batch at
+    a time. Returns the number of comments and votes imported.'''
+    comments = Comment.__table__
+    votes = Vote.__table__
+    offset = reserve_comment_ids(max_id)
+    counts = {'comment': 0, 'vote': 0}
+    thread_names = set()
+    thread_ids = set()
+
+    for batch in chunks(records, batch_size):
+        authors = resolve_names(Author, (r['author'] for r in batch))
+        threads = resolve_names(Thread, (r['thread'] for r in batch
+                                         if r['type'] == 'comment'))
+        new_comments = []
+        new_votes = []
+        for r in batch:
+            if r['type'] == 'comment':
+                parent_id = r.get('parent_id')
+                new_comments.append({
+                    'id': r['id'] + offset,
+                    'thread_id': threads[r['thread']],
+                    'author_id': authors[r['author']],
+                    'text': r['text'],
+                    'created': arrow.get(r['created']),
+                    'modified': arrow.get(r.get('modified', r['created'])),
+                    'parent_id': (parent_id + offset
+                                  if parent_id is not None else None),
+                    'hidden': r.get('hidden', False),
+                    'likes': 0,
+                    'dislikes': 0,
+                })
+            elif r['type'] == 'vote':
+                new_votes.append({
+                    'comment_id': r['comment_id'] + offset,
+                    'author_id': authors[r['author']],
+                    'like': r['like'],
+                })
+            else:
+                raise ValueError('Unknown record type: %s' % r['type'])
+        # Comments of a batch go before its votes, which may refer to them
+        if new_comments:
+            db.session.execute(comments.insert(), new_comments)
+        if new_votes:
+            db.session.execute(votes.insert(), new_votes)
+        db.session.commit()
+        thread_names.update(threads)
+        thread_ids.update(threads.values())
+        counts['comment'] += len(new_comments)
+        counts['vote'] += len(new_votes)
+        if log:
+            log('%(comment)d comments, %(vote)d votes' % counts)
+
+    # Only the imported comments lack paths
+    build_paths()
+    db.session.commit()
+    for first_id in range(offset + 1, offset + max_id + 1, batch_size):
+        recount_votes(id_range=(first_id, first_id + batch_size))
+        db.session.commit()
+    for batch in chunks(sorted(thread_ids), batch_size):
+        recount_threads(thread_ids=batch)
+        db.session.commit()
+    for thread_name in thread_names:
+        thread_cache.invalidate(thread_name)
+    return counts['comment'], counts['vote']
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import json
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''A thread safe, bounded, least recently used mapping.'''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            # Reinsert to mark as the most recently used
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def incr(self, key):
+        with self.lock:
+            value = self.data.pop(key, 0) + 1
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class TTLCache(LRUCache):
+    '''LRUCache whose entries expire after ttl seconds (or earlier, if
+    asked). Counts hits and misses.'''
+
+    def __init__(self, maxsize=1024, ttl=300):
+        super(TTLCache, self).__init__(maxsize)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = super(TTLCache, self).get(key)
+        with self.lock:
+            if entry is None or entry[1] <= time.time():
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires=None):
+        '''Store a value until ttl seconds from now, or until expires (a
+        timestamp), if it comes first.'''
+        limit = time.time() + self.ttl
+        if expires is None or expires > limit:
+            expires = limit
+        super(TTLCache, self).set(key, (value, expires))
+
+
+class RedisBackend(object):
+    '''Cache backend shared between processes, using Redis.
+    Values are stored as JSON.'''
+
+    def __init__(self, url, prefix='tagarela:', timeout=None):
+        '''Values set expire after timeout seconds (if not None); counters
+        never do.'''
+        # Only needed if this backend is used
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def get(self, key, default=None):
+        value = self.redis.get(self.prefix + key)
+        if value is None:
+            return default
+        return json.loads(value.decode('utf-8'))
+
+    def set(self, key, value):
+        self.redis.set(self.prefix + key, json.dumps(value), ex=self.timeout)
+
+    def incr(self, key):
+        return self.redis.incr(self.prefix + key)
+
+    def clear(self):
+        for key in self.redis.scan_iter(self.prefix + '*'):
+            self.redis.delete(key)
+
+
+class ThreadCache(object):
+    '''Cache for serialized threads.
+    Each thread has a version counter, bumped on every write. Payloads are
+    stored under the thread name plus its version, so old payloads are
+    never served after a write, even if a slow reader stores them late.'''
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def init_app(self, app):
+        '''Configure the backend from THREAD_CACHE_* settings. By default,
+        uses Redis if THREAD_CACHE_REDIS_URL is set, else no cache.'''
+        default = 'redis' if app.config.get('THREAD_CACHE_REDIS_URL') else None
+        kind = app.config.get('THREAD_CACHE_BACKEND', default)
+        if kind == 'lru':
+            self.backend = LRUCache(app.config.get('THREAD_CACHE_SIZE', 1024))
+        elif kind == 'redis':
+            self.backend = RedisBackend(
+                app.config['THREAD_CACHE_REDIS_URL'],
+                timeout=app.config.get('THREAD_CACHE_TIMEOUT', 24 * 60 * 60))
+        elif kind is None:
+            self.backend = None
+        else:
+            raise ValueError('Unknown THREAD_CACHE_BACKEND: %s' % kind)
+
+    def version(self, thread_name):
+        '''Return the current version of a thread.'''
+        if self.backend is None:
+            return 0
+        return int(self.backend.get('version:' + thread_name, 0))
+
+    def get(self, thread_name, version):
+        '''Return the cached payload for a thread version, or None.'''
+        if self.backend is None:
+            return None
+        return self.backend.get('thread:%s:%s' % (version, thread_name))
+
+    def set(self, thread_name, version, payload):
+        '''Store the payload for a thread version.'''
+        if self.backend is not None:
+            self.backend.set('thread:%s:%s' % (version, thread_name), payload)
+
+    def invalidate(self, thread_name):
+        '''Bump the version of a thread. Returns the new version.'''
+        if self.backend is None:
+            return 0
+        return self.backend.incr('version:' + thread_name)
@@ -3,21 +3,149 @@
 
 from __future__ import unicode_literals  # unicode by default
 import json
+import base64
+import hashlib
 
+from flask import request, Response
 from flask.ext.restplus import Api
+from sqlalchemy import and_, or_, tuple_, literal
+from werkzeug.http import http_date, quote_etag
 
 
-def paginate(query, page, per_page_num):
-    '''Paginate a query, returning also the total before pagination.'''
-    total = query.count()
+def paginate(query, page, per_page_num, total='exact'):
+    '''Paginate a query, returning also the total before pagination.
+    See count_total for the total modes.'''
+    total = count_total(query, total)
     return (query.offset(page*per_page_num).limit(per_page_num).all(), total)
 
 
+def paginate_keyset(query, columns, values, per_page_num, descending=True):
+    '''Paginate a query ordered by columns, returning the rows after values.
+    Unlike OFFSET, this costs the same for any page if there is an index on
+    the columns. Returns also whether there are more rows after this page.'''
+    if values is not None:
+        row_values = query.session.bind.dialect.name == 'postgresql'
+        query = query.filter(keyset_filter(columns, values, descending,
+                                           row_values))
+    rows = query.limit(per_page_num + 1).all()
+    return rows[:per_page_num], len(rows) > per_page_num
+
+
+def keyset_filter(columns, values, descending=True, row_values=True):
+    '''Filter rows coming after values, in the lexicographic order of
+    columns. With row_values, uses a row comparison ((a, b) < (x, y)), which
+    an index on the columns serves as a range; else (for DBs without row
+    values, like older SQLite) an equivalent chain of ORs.'''
+    if row_values:
+        left = tuple_(*columns)
+        right = tuple_(*[literal(v, c.type) for c, v in zip(columns, values)])
+        return left < right if descending else left > right
+    clauses = []
+    for i, column in enumerate(columns):
+        if descending:
+            after = column < values[i]
+        else:
+            after = column > values[i]
+        equals = [c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(and_(*(equals + [after])))
+    return or_(*clauses)
+
+
+def encode_cursor(*values):
+    '''Encode JSON serializable values as an opaque cursor.'''
+    data = json.dumps(values).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''Decode a cursor created by encode_cursor.
+    Raises ValueError if it is invalid.'''
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        return json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+
+
+def count_total(query, mode='exact'):
+    '''Count the rows of a query.
+    mode can be 'exact', 'estimate' (cheap, using the query planner) or
+    'none' (no count at all, returns None).'''
+    if mode == 'none':
+        return None
+    query = query.order_by(None)
+    if mode == 'estimate':
+        return estimate_count(query)
+    return query.count()
+
+
+def estimate_count(query):
+    '''Return the query planner's estimate of the number of rows of a query.
+    Only Postgres is supported; other databases get an exact count.'''
+    session = query.session
+    dialect = session.bind.dialect
+    if dialect.name != 'postgresql':
+        return query.count()
+    compiled = query.statement.compile(dialect=dialect)
+    plan = session.connection().execute(
+        'EXPLAIN (FORMAT JSON) ' + compiled.string, compiled.params).scalar()
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def select_related(session, model, **columns):
+    '''Query a model along with the related columns it serializes.
+    Each keyword names a column of another model, which is joined through
+    its foreign key, so rows carry everything needed without lazy loads.
+    Rows have the model under its class name and each column under its
+    keyword.'''
+    columns = sorted(columns.items())
+    query = session.query(model, *[c.label(name) for name, c in columns])
+    joined = set()
+    for name, column in columns:
+        if column.class_ not in joined:
+            query = query.join(column.class_)
+            joined.add(column.class_)
+    return query
+
+
 def date_to_json(date):
     '''Helper to format dates.'''
     return str(date)
 
 
+def make_etag(*parts):
+    '''Build a strong ETag (unquoted) from the values that identify a
+    representation.'''
+    key = '|'.join('%s' % (p,) for p in parts)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def conditional_response(etag, last_modified=None):
+    '''Check the conditional headers of the current request.
+    Returns the validator headers to send and, if the client's copy is still
+    fresh, a 304 response to be returned instead of building the body.
+    last_modified is an Arrow date (or None).'''
+    headers = {'ETag': quote_etag(etag)}
+    if last_modified is not None:
+        # HTTP dates have a resolution of seconds
+        last_modified = last_modified.to('utc').naive.replace(microsecond=0)
+        headers['Last-Modified'] = http_date(last_modified)
+
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        fresh = etag in request.if_none_match
+    elif request.if_modified_since and last_modified is not None:
+        fresh = last_modified <= request.if_modified_since
+    else:
+        fresh = False
+
+    if fresh:
+        return headers, Response(status=304, headers=headers)
+    return headers, None
+
+
 class ExtraApi(Api):
 
     def __init__(self, *args, **kwargs):
@@ -32,6 +160,16 @@ class ExtraApi(Api):
                 'default': 0,
                 'help': 'Page doc!!',
             },
+            'cursor': {
+                'help': 'Opaque cursor returned as "next" by the previous '
+                'page. Faster than "page" for deep pages.',
+            },
+            'total': {
+                'default': 'exact',
+                'choices': ('exact', 'estimate', 'none'),
+                'help': 'How to compute the total: "exact", "estimate" '
+                '(approximated, but cheap) or "none".',
+            },
             'per_page_num': {
                 'type': int,
                 'default': 20,
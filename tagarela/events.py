@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import json
+import time
+import threading
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+
+class LocalBroker(object):
+    '''In-process fan-out of messages: each subscriber has its own bounded
+    queue. Only subscribers of the same process receive the messages.'''
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.channels = {}
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriptions = list(self.channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def subscribe(self, channel):
+        subscription = LocalSubscription(self, channel, self.queue_size)
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.channels.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.channels.pop(subscription.channel, None)
+
+
+class LocalSubscription(object):
+    '''Queue of the messages of a channel for one subscriber. If a slow
+    subscriber lets it fill up, its messages are dropped and it gets a
+    "reset" event instead.'''
+
+    def __init__(self, broker, channel, size):
+        self.broker = broker
+        self.channel = channel
+        self.queue = Queue(size)
+        self.overflow = False
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except Full:
+            self.overflow = True
+
+    def get(self, timeout):
+        '''Return the next message, or None after timeout seconds.'''
+        if self.overflow:
+            self.overflow = False
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            return {'event': 'reset', 'id': None, 'data': None}
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class RedisBroker(object):
+    '''Fan-out of messages between processes, using Redis pub/sub.
+    Messages are sent as JSON.'''
+
+    def __init__(self, url, prefix='tagarela:events:'):
+        # Only needed if this broker is used
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+    def publish(self, channel, message):
+        self.redis.publish(self.prefix + channel, json.dumps(message))
+
+    def subscribe(self, channel):
+        return RedisSubscription(self.redis, self.prefix + channel)
+
+
+class RedisSubscription(object):
+    '''Messages of a Redis channel for one subscriber.'''
+
+    def __init__(self, redis, channel):
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def get(self, timeout):
+        '''Return the next message, or None after timeout seconds.'''
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            message = self.pubsub.get_message(timeout=remaining)
+            if message is not None and message['type'] == 'message':
+                return json.loads(message['data'].decode('utf-8'))
+
+    def close(self):
+        self.pubsub.close()
+
+
+class EventHub(object):
+    '''Publishes the changes of threads to their subscribers, to be sent as
+    Server-Sent Events. Each message has an event name, an id (the version
+    of the thread) and some JSON data.'''
+
+    def __init__(self, broker=None):
+        self.broker = broker
+        self.heartbeat = 15
+
+    @property
+    def enabled(self):
+        return self.broker is not None
+
+    def init_app(self, app):
+        '''Configure the broker from EVENTS_* settings. Disabled by
+        default.'''
+        kind = app.config.get('EVENTS_BACKEND')
+        if kind == 'local':
+            self.broker = LocalBroker(app.config.get('EVENTS_QUEUE_SIZE', 100))
+        elif kind == 'redis':
+            self.broker = RedisBroker(app.config['EVENTS_REDIS_URL'])
+        elif kind is None:
+            self.broker = None
+        else:
+            raise ValueError('Unknown EVENTS_BACKEND: %s' % kind)
+        self.heartbeat = app.config.get('EVENTS_HEARTBEAT', 15)
+
+    def publish(self, thread_name, event, version, data):
+        '''Send an event to the subscribers of a thread.'''
+        if self.broker is not None:
+            self.broker.publish(thread_name, {
+                'event': event,
+                'id': version,
+                'data': data,
+            })
+
+    def subscribe(self, thread_name):
+        '''Return a subscription to the events of a thread. It has
+        get(timeout) and must be closed with close().'''
+        return self.broker.subscribe(thread_name)
+
+
+def format_event(message):
+    '''Return a message in the text/event-stream format.'''
+    lines = []
+    if message.get('id') is not None:
+        lines.append('id: %s' % message['id'])
+    lines.append('event: %s' % message['event'])
+    lines.append('data: %s' % json.dumps(message.get('data')))
+    return '\n'.join(lines) + '\n\n'
+
+
+events = EventHub()
@@ -1,10 +1,144 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import math
+import threading
+from contextlib import contextmanager
+
+from flask import request, has_request_context, _app_ctx_stack
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, exc, select
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 from viratoken import SignerVerifier
 
+from cache import ThreadCache, TTLCache
+
 
 db = SQLAlchemy()
 sv = SignerVerifier()
+thread_cache = ThreadCache()
+# Verified token hash -> username
+token_cache = TTLCache()
+
+
+def tune_engine(engine, config):
+    '''Set up an engine using SQLALCHEMY_POOL_PRE_PING,
+    SQLALCHEMY_STATEMENT_TIMEOUT and SQLALCHEMY_BUSY_TIMEOUT. On SQLite,
+    fixes savepoints and adds the SQL functions missing.'''
+    if config.get('SQLALCHEMY_POOL_PRE_PING'):
+        @event.listens_for(engine, 'engine_connect')
+        def ping_connection(connection, branch):
+            # http://docs.sqlalchemy.org/en/rel_1_0/core/pooling.html
+            # #disconnect-handling-pessimistic
+            if branch:
+                return
+            should_close = connection.should_close_with_result
+            connection.should_close_with_result = False
+            try:
+                connection.scalar(select([1]))
+            except exc.DBAPIError as err:
+                # A stale connection is invalidated, retrying reconnects
+                if err.connection_invalidated:
+                    connection.scalar(select([1]))
+                else:
+                    raise
+            finally:
+                connection.should_close_with_result = should_close
+
+    if engine.dialect.name == 'sqlite':
+        busy_timeout = config.get('SQLALCHEMY_BUSY_TIMEOUT') or 5000
+
+        @event.listens_for(engine, 'connect')
+        def set_up_sqlite(dbapi_connection, connection_record):
+            # Missing in SQLite, used by models.score_expression
+            dbapi_connection.create_function('sqrt', 1, math.sqrt)
+            # pysqlite commits the open transaction before a SAVEPOINT,
+            # breaking begin_nested(): let SQLAlchemy emit BEGIN instead
+            # http://docs.sqlalchemy.org/en/rel_1_0/dialects/sqlite.html
+            # #serializable-isolation-savepoints-transactional-ddl
+            dbapi_connection.isolation_level = None
+            dbapi_connection.execute('PRAGMA busy_timeout = %d' %
+                                     busy_timeout)
+
+        @event.listens_for(engine, 'begin')
+        def begin_sqlite(connection):
+            # Writes take the write lock upfront, so transactions that read
+            # and then write can't deadlock each other
+            connection.execute('BEGIN IMMEDIATE' if writes() else 'BEGIN')
+
+    timeout = config.get('SQLALCHEMY_STATEMENT_TIMEOUT')
+    if timeout and engine.dialect.name == 'postgresql':
+        @event.listens_for(engine, 'connect')
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SET statement_timeout = %d' % timeout)
+            cursor.close()
+            dbapi_connection.commit()
+
+
+_writing = threading.local()
+
+
+@contextmanager
+def writing():
+    '''Make the transactions begun in the block take the write lock of
+    SQLite upfront, as those of requests that may write do (see writes).'''
+    _writing.depth = getattr(_writing, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _writing.depth -= 1
+
+
+def writes():
+    '''Return if the transactions begun now may write: in requests other
+    than GET, HEAD and OPTIONS and in writing() blocks.'''
+    if getattr(_writing, 'depth', 0):
+        return True
+    return (has_request_context() and
+            request.method not in ('GET', 'HEAD', 'OPTIONS'))
+
+
+def engine_options(config):
+    '''Return the pool options for create_engine set in config.'''
+    options = {}
+    for option in ('pool_size', 'max_overflow', 'pool_timeout',
+                   'pool_recycle'):
+        value = config.get('SQLALCHEMY_' + option.upper())
+        if value is not None:
+            options[option] = value
+    return options
+
+
+class Replica(object):
+    '''Read replica of the DB (SQLALCHEMY_REPLICA_URI), for the read only
+    queries of GET requests. Writes always go to the primary (db.session).'''
+
+    def __init__(self):
+        self.session = None
+
+    def init_app(self, app):
+        uri = app.config.get('SQLALCHEMY_REPLICA_URI')
+        if not uri:
+            return
+        engine = create_engine(uri, **engine_options(app.config))
+        tune_engine(engine, app.config)
+        self.session = scoped_session(
+            sessionmaker(bind=engine),
+            scopefunc=_app_ctx_stack.__ident_func__)
+
+        @app.teardown_appcontext
+        def remove_session(exception):
+            self.session.remove()
+
+    def reads(self):
+        '''Return the session for read only queries: the replica's in GET
+        requests, if configured, else the primary's.'''
+        if (self.session is not None and has_request_context() and
+                request.method in ('GET', 'HEAD')):
+            return self.session
+        return db.session
+
+
+replica = Replica()
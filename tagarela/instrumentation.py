@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import time
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from extensions import token_cache
+
+
+# Metrics summed for each endpoint: (name, help)
+METRICS = (
+    ('requests_total', 'Number of requests.'),
+    ('request_seconds_total', 'Time spent answering requests.'),
+    ('db_queries_total', 'Number of SQL queries.'),
+    ('db_seconds_total', 'Time spent in SQL queries.'),
+    ('serialize_seconds_total', 'Time spent serializing comments.'),
+    ('response_bytes_total', 'Size of the responses (if not streamed).'),
+)
+
+
+class Instrumentation(object):
+    '''Opt-in measures of each request: SQL queries count and time,
+    serialization time and response size. They are sent in a Server-Timing
+    header and summed by endpoint in /metrics (Prometheus format, for this
+    process only). Slow queries are logged.'''
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.stats = defaultdict(lambda: defaultdict(float))
+
+    def init_app(self, app):
+        '''Configure from INSTRUMENTATION and SLOW_QUERY_THRESHOLD.'''
+        self.app = app
+        self.enabled = app.config.get('INSTRUMENTATION', False)
+        self.slow_query_threshold = app.config.get('SLOW_QUERY_THRESHOLD',
+                                                   0.5)
+        if not self.enabled:
+            return
+        event.listen(Engine, 'before_cursor_execute', self.before_query)
+        event.listen(Engine, 'after_cursor_execute', self.after_query)
+        app.before_request(self.start_request)
+        app.after_request(self.end_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics)
+
+    def before_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        conn.info.setdefault('query_start', []).append(time.time())
+
+    def after_query(self, conn, cursor, statement, parameters, context,
+                    executemany):
+        elapsed = time.time() - conn.info['query_start'].pop()
+        if elapsed > self.slow_query_threshold:
+            self.app.logger.warning('Slow query (%.3fs): %s', elapsed,
+                                    statement)
+        if has_request_context() and g.get('metrics') is not None:
+            g.metrics['db_queries_total'] += 1
+            g.metrics['db_seconds_total'] += elapsed
+
+    @contextmanager
+    def timed(self, metric):
+        '''Add the time spent in the block to a metric of the request. After
+        the response has started (e.g. streamed), the time only goes to the
+        totals of /metrics.'''
+        if not self.enabled or not has_request_context():
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            metrics = g.get('metrics')
+            if metrics is not None:
+                metrics[metric] += elapsed
+            else:
+                with self.lock:
+                    self.stats[request.endpoint or 'unknown'][metric] += (
+                        elapsed)
+
+    def start_request(self):
+        g.metrics = defaultdict(float)
+        g.metrics_start = time.time()
+
+    def end_request(self, response):
+        metrics = g.get('metrics')
+        if metrics is None:
+            return response
+        g.metrics = None
+        metrics['requests_total'] = 1
+        metrics['request_seconds_total'] = time.time() - g.metrics_start
+        if not response.is_streamed:
+            metrics['response_bytes_total'] = len(response.get_data())
+        response.headers['Server-Timing'] = (
+            'db;desc="%d queries";dur=%.1f, serialize;dur=%.1f, '
+            'total;dur=%.1f' % (
+                metrics['db_queries_total'],
+                1000 * metrics['db_seconds_total'],
+                1000 * metrics['serialize_seconds_total'],
+                1000 * metrics['request_seconds_total']))
+        with self.lock:
+            stats = self.stats[request.endpoint or 'unknown']
+            for name, value in metrics.items():
+                stats[name] += value
+        return response
+
+    def metrics(self):
+        '''Return the metrics in Prometheus text format.'''
+        lines = []
+        with self.lock:
+            for name, help in METRICS:
+                lines.append('# HELP tagarela_%s %s' % (name, help))
+                lines.append('# TYPE tagarela_%s counter' % name)
+                for endpoint, stats in sorted(self.stats.items()):
+                    lines.append('tagarela_%s{endpoint="%s"} %s' % (
+                        name, endpoint, stats[name]))
+        for name in ('hits', 'misses'):
+            lines.append('# TYPE tagarela_token_cache_%s_total counter' %
+                         name)
+            lines.append('tagarela_token_cache_%s_total %s' % (
+                name, getattr(token_cache, name)))
+        return Response('\n'.join(lines) + '\n',
+                        mimetype='text/plain; version=0.0.4')
+
+
+instrumentation = Instrumentation()
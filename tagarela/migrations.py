@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from extensions import db
+
+
+def migrate(engine, log=None):
+    '''Bring an existing DB up to date with the models, without losing
+    data: create the missing tables, add the missing (nullable or with a
+    server default) columns and create the missing indexes. On Postgres,
+    indexes are created CONCURRENTLY, so the tables aren't locked.
+    Returns the (table, column) names of the columns added.'''
+    log = log or (lambda msg: None)
+    db.metadata.create_all(engine)
+
+    added = []
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, column.name,
+                column.type.compile(dialect=engine.dialect))
+            if column.server_default is not None:
+                ddl += ' DEFAULT %s' % column.server_default.arg
+            log(ddl)
+            engine.execute(ddl)
+            added.append((table.name, column.name))
+
+    postgres = engine.dialect.name == 'postgresql'
+    connection = engine.connect()
+    if postgres:
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction
+        connection = connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+    try:
+        for table in db.metadata.sorted_tables:
+            existing = existing_indexes(connection, table.name)
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                if index.name in existing:
+                    continue
+                ddl = '%s' % CreateIndex(index).compile(dialect=engine.dialect)
+                if postgres:
+                    ddl = ddl.replace('INDEX ', 'INDEX CONCURRENTLY ', 1)
+                log(ddl)
+                connection.execute(ddl)
+    finally:
+        connection.close()
+    return added
+
+
+def existing_indexes(connection, table_name):
+    '''Return the names of the indexes of a table.'''
+    if connection.dialect.name == 'postgresql':
+        # Reflection skips some indexes (e.g. with expressions)
+        return set(name for name, in connection.execute(
+            text('SELECT indexname FROM pg_indexes '
+                 'WHERE tablename = :table'), table=table_name))
+    return set(i['name'] for i in
+               inspect(connection).get_indexes(table_name))
+
+
+def index_usage(engine):
+    '''Return (table, index, scans, tuples read, size) for each index, from
+    the statistics of Postgres.'''
+    return engine.execute('''
+        SELECT relname, indexrelname, idx_scan, idx_tup_read,
+               pg_size_pretty(pg_relation_size(indexrelid))
+        FROM pg_stat_user_indexes
+        ORDER BY relname, indexrelname
+    ''').fetchall()
@@ -1,9 +1,15 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import arrow
+from sqlalchemy import (func, select, exists, text, cast, case, or_,
+                        literal_column, String)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy_utils import ArrowType
 
 from extensions import db
+from cache import LRUCache
 
 
 class Vote(db.Model):
@@ -42,37 +48,450 @@ class Comment(db.Model):
                                backref=db.backref('parent',
                                                   remote_side=[id]))
     hidden = db.Column(db.Boolean(), default=False)
+    # Ranking by votes, see score_expression
+    score = db.Column(db.Float(), nullable=False, default=0,
+                      server_default=db.text('0'))
+    # Materialized path: the ids of the ancestors and of the comment itself,
+    # each with PATH_DIGITS digits. Set after insert (see set_comment_path).
+    path = db.Column(db.Text(), nullable=True)
+
+    @property
+    def depth(self):
+        '''Depth of the comment in its thread (0 for root comments).'''
+        return len(self.path) // PATH_DIGITS - 1
+
+    @property
+    def ancestor_ids(self):
+        '''Ids of the ancestors of the comment, from the root.'''
+        return [int(self.path[i:i + PATH_DIGITS])
+                for i in range(0, len(self.path) - PATH_DIGITS, PATH_DIGITS)]
 
     def set_vote(self, author_id, like):
-        vote = db.session.query(Vote).filter_by(
-            comment_id=self.id,
-            author_id=author_id
-        ).first()
-
-        if vote:
-            if vote.like == like:
-                # Vote exists and is the same
+        '''Register the vote of an author for this comment.
+        Counters are changed inside the DB (likes = likes + 1), in the same
+        statement as the vote upsert when possible, so concurrent votes are
+        never lost. Returns True if the vote already existed unchanged.
+        Doesn't commit.'''
+        params = {'comment_id': self.id, 'author_id': author_id, 'like': like}
+        if upsert_supported():
+            changed = db.session.execute(VOTE_UPSERT, params).rowcount
+            return True if not changed else None
+
+        votes = Vote.__table__
+        try:
+            with db.session.begin_nested():
+                db.session.execute(votes.insert().values(**params))
+        except IntegrityError:
+            # Vote exists: change it, unless it is the same
+            changed = db.session.execute(
+                votes.update()
+                .where(votes.c.comment_id == self.id)
+                .where(votes.c.author_id == author_id)
+                .where(votes.c.like != like)
+                .values(like=like)).rowcount
+            if not changed:
                 return True
-            else:
-                # Vote exists but changed
-                vote.like = like
-                if like:
-                    # changed to a like
-                    self.likes += 1
-                    self.dislikes -= 1
-                else:
-                    # changed to a dislike
-                    self.likes -= 1
-                    self.dislikes += 1
+            likes, dislikes = (1, -1) if like else (-1, 1)
         else:
             # New vote
-            vote = Vote(comment_id=self.id, author_id=author_id, like=like)
-            db.session.add(vote)
-            if like:
-                self.likes += 1
-            else:
-                self.dislikes += 1
-        db.session.commit()
+            likes, dislikes = (1, 0) if like else (0, 1)
+
+        comments = Comment.__table__
+        db.session.execute(
+            comments.update()
+            .where(comments.c.id == self.id)
+            .values(likes=comments.c.likes + likes,
+                    dislikes=comments.c.dislikes + dislikes))
+        recompute_scores([self.id])
+        bump_thread_versions([self.id])
+
+
+# Same as VOTE_UPSERT, without touching the counters. Used for batches of
+# votes, which are recounted afterwards.
+VOTES_UPSERT = text('''
+INSERT INTO votes (comment_id, author_id, "like")
+VALUES (:comment_id, :author_id, :like)
+ON CONFLICT (comment_id, author_id) DO UPDATE SET "like" = EXCLUDED."like"
+''')
+
+
+def apply_votes(votes):
+    '''Apply many votes at once, then recount the votes of their comments.
+    votes maps (comment_id, author_id) to like. Votes for comments that no
+    longer exist are ignored. Returns the ids of the affected comments.
+    Doesn't commit.'''
+    comment_ids = set(comment_id for comment_id, author_id in votes)
+    comment_ids = set(c for c, in db.session.query(Comment.id)
+                      .filter(Comment.id.in_(comment_ids)))
+    rows = [{'comment_id': comment_id, 'author_id': author_id, 'like': like}
+            for (comment_id, author_id), like in votes.items()
+            if comment_id in comment_ids]
+    if not rows:
+        return comment_ids
+
+    if upsert_supported():
+        db.session.execute(VOTES_UPSERT, rows)
+    else:
+        for row in rows:
+            db.session.merge(Vote(**row))
+    recount_votes(comment_ids)
+    return comment_ids
+
+
+def recount_votes(comment_ids=None, id_range=None):
+    '''Rebuild likes and dislikes from the votes table, in one statement.
+    Recounts all comments if comment_ids and id_range (first, last + 1) are
+    None. Doesn't commit.'''
+    votes = Vote.__table__
+    comments = Comment.__table__
+
+    def count(like):
+        return (select([func.count()])
+                .where(votes.c.comment_id == comments.c.id)
+                .where(votes.c.like == like)
+                .as_scalar())
+
+    query = comments.update().values(likes=count(True), dislikes=count(False))
+    if comment_ids is not None:
+        query = query.where(comments.c.id.in_(comment_ids))
+    if id_range is not None:
+        query = query.where(comments.c.id.between(id_range[0],
+                                                  id_range[1] - 1))
+    db.session.execute(query)
+    recompute_scores(comment_ids, id_range)
+    bump_thread_versions(comment_ids, id_range)
+
+
+# z for a confidence of 95% in the Wilson score
+SCORE_Z = 1.96
+
+
+def score_expression(likes, dislikes):
+    '''SQL expression of the lower bound of the Wilson score interval for
+    the fraction of likes: a comment with few votes ranks below one with
+    many votes and the same fraction. 0 without votes.'''
+    n = likes + dislikes
+    z2 = SCORE_Z * SCORE_Z
+    return case(
+        [(n == 0, 0.0)],
+        else_=((likes + z2 / 2 -
+                SCORE_Z * func.sqrt(likes * 1.0 * dislikes / n + z2 / 4)) /
+               (n + z2)))
+
+
+def recompute_scores(comment_ids=None, id_range=None):
+    '''Set Comment.score from the counters, in one statement. Recomputes all
+    comments if comment_ids and id_range (first, last + 1) are None.
+    Doesn't commit.'''
+    comments = Comment.__table__
+    query = comments.update().values(
+        score=score_expression(comments.c.likes, comments.c.dislikes))
+    if comment_ids is not None:
+        query = query.where(comments.c.id.in_(comment_ids))
+    if id_range is not None:
+        query = query.where(comments.c.id.between(id_range[0],
+                                                  id_range[1] - 1))
+    db.session.execute(query)
+
+
+# Changes of the counters of a comment after a vote (in VOTE_UPSERT)
+LIKES_CHANGE = 'CASE WHEN :like THEN 1 WHEN vote.inserted THEN 0 ELSE -1 END'
+DISLIKES_CHANGE = ('CASE WHEN NOT :like THEN 1 WHEN vote.inserted THEN 0 '
+                   'ELSE -1 END')
+
+# Inserts or changes a vote, updating the counters and the score of the
+# comment and the version of its thread, in one statement. Nothing happens
+# if the vote exists and is the same.
+# "xmax = 0" is only true for rows that were inserted (not updated).
+VOTE_UPSERT = text('''
+WITH vote AS (
+    INSERT INTO votes (comment_id, author_id, "like")
+    VALUES (:comment_id, :author_id, :like)
+    ON CONFLICT (comment_id, author_id) DO UPDATE SET "like" = EXCLUDED."like"
+    WHERE votes."like" <> EXCLUDED."like"
+    RETURNING (xmax = 0) AS inserted
+), counted AS (
+    UPDATE comment SET
+        likes = likes + {likes},
+        dislikes = dislikes + {dislikes},
+        score = {score}
+    FROM vote
+    WHERE comment.id = :comment_id
+    RETURNING comment.thread_id
+)
+UPDATE thread SET version = version + 1
+FROM counted
+WHERE thread.id = counted.thread_id
+'''.format(
+    likes=LIKES_CHANGE,
+    dislikes=DISLIKES_CHANGE,
+    score=score_expression(
+        literal_column('(comment.likes + %s)' % LIKES_CHANGE),
+        literal_column('(comment.dislikes + %s)' % DISLIKES_CHANGE),
+    ).compile(dialect=postgresql.dialect(),
+              compile_kwargs={'literal_binds': True})))
+
+
+# Inserts a name if needed, returning the id of its row in any case.
+# The DO UPDATE is needed so the existing row is returned on conflict.
+NAME_UPSERT = '''
+INSERT INTO {table} (name) VALUES (:name)
+ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+RETURNING id, (xmax = 0) AS inserted
+'''
+
+# Cache of name -> id, for authors and threads (names never change)
+name_ids = {
+    'author': LRUCache(10000),
+    'thread': LRUCache(10000),
+}
+
+
+def get_id_add_if_needed(model, name):
+    '''Return the id of the Author or Thread with name, adding it if needed.
+    Doesn't commit. Ids are only cached once they are known to be committed,
+    so a rolled back insert is never cached.'''
+    cache = name_ids[model.__tablename__]
+    model_id = cache.get(name)
+    if model_id is not None:
+        return model_id
+
+    if upsert_supported():
+        model_id, inserted = db.session.execute(
+            NAME_UPSERT.format(table=model.__tablename__),
+            {'name': name}).first()
+    else:
+        model_id = (db.session.query(model.id)
+                    .filter(model.name == name).scalar())
+        inserted = model_id is None
+        if inserted:
+            try:
+                with db.session.begin_nested():
+                    row = model(name=name)
+                    db.session.add(row)
+                model_id = row.id
+            except IntegrityError:
+                # Added by someone else meanwhile
+                model_id = (db.session.query(model.id)
+                            .filter(model.name == name).scalar())
+                inserted = False
+
+    if not inserted:
+        cache.set(name, model_id)
+    return model_id
+
+
+def upsert_supported():
+    '''Whether the DB supports INSERT ... ON CONFLICT (Postgres 9.5+).'''
+    dialect = db.session.connection().dialect
+    return (dialect.name == 'postgresql' and
+            (dialect.server_version_info or (0,)) >= (9, 5))
+
+
+# Backs the listing of visible comments by decrescent creation time
+db.Index('ix_comment_hidden_created_id_desc',
+         Comment.hidden, Comment.created.desc(), Comment.id.desc())
+# And by decrescent score
+db.Index('ix_comment_hidden_score_id_desc',
+         Comment.hidden, Comment.score.desc(), Comment.id.desc())
+
+
+def delete_comments(comment_ids):
+    '''Delete comments, hiding instead the ones with replies, and then the
+    hidden ancestors left without replies, with a few bulk statements.
+    Returns the ids of the deleted comments. Doesn't commit.'''
+    comments = Comment.__table__
+    children = comments.alias('child')
+    has_replies = exists().where(children.c.parent_id == comments.c.id)
+    thread_ids = [thread_id for thread_id, in db.session.execute(
+        select([comments.c.thread_id])
+        .where(comments.c.id.in_(comment_ids))
+        .distinct())]
+
+    db.session.execute(comments.update()
+                       .where(comments.c.id.in_(comment_ids))
+                       .where(has_replies)
+                       .values(hidden=True, modified=arrow.utcnow()))
+    removed = [comment_id for comment_id, in db.session.execute(
+        select([comments.c.id])
+        .where(comments.c.id.in_(comment_ids))
+        .where(~has_replies))]
+
+    deleted = removed
+    while deleted:
+        found = [comment_id for comment_id
+                 in hidden_ancestors_without_replies(deleted)
+                 if comment_id not in deleted]
+        deleted.extend(found)
+        # When deleting a single comment, each ancestor in the chain has
+        # only one reply, so the chain found is already complete.
+        if not found or len(comment_ids) == 1:
+            break
+
+    counts = {}
+    if deleted:
+        counts = dict(db.session.execute(
+            select([comments.c.thread_id, func.count()])
+            .where(comments.c.id.in_(deleted))
+            .group_by(comments.c.thread_id)).fetchall())
+        votes = Vote.__table__
+        db.session.execute(votes.delete()
+                           .where(votes.c.comment_id.in_(deleted)))
+        db.session.execute(comments.delete()
+                           .where(comments.c.id.in_(deleted)))
+    for thread_id in thread_ids:
+        update_thread_activity(thread_id, -counts.get(thread_id, 0))
+    return deleted
+
+
+def hidden_ancestors_without_replies(removed):
+    '''Return the ids of the hidden ancestors of the removed comments that
+    would be left without replies, in one recursive query: the hidden parents
+    whose replies are all being removed, then their hidden ancestors with a
+    single reply (the one in the chain).'''
+    comments = Comment.__table__
+    parents = comments.alias('parent')
+    children = comments.alias('child')
+    chain = (select([parents.c.id, parents.c.parent_id])
+             .where(parents.c.id.in_(select([comments.c.parent_id])
+                                     .where(comments.c.id.in_(removed))))
+             .where(parents.c.hidden)
+             .where(~exists().where(children.c.parent_id == parents.c.id)
+                    .where(~children.c.id.in_(removed)))
+             .cte('chain', recursive=True))
+    ancestors = comments.alias('ancestor')
+    replies = (select([func.count()])
+               .where(children.c.parent_id == ancestors.c.id)
+               .as_scalar())
+    chain = chain.union_all(
+        select([ancestors.c.id, ancestors.c.parent_id])
+        .where(ancestors.c.id == chain.c.parent_id)
+        .where(ancestors.c.hidden)
+        .where(replies == 1))
+    result = db.session.execute(select([chain.c.id]))
+    # Python 2's sqlite3 returns no cursor description (so no rows to
+    # iterate) when a WITH query finds nothing
+    if not result.returns_rows:
+        return []
+    return [comment_id for comment_id, in result]
+
+
+# Digits used for each id in Comment.path
+PATH_DIGITS = 10
+
+
+def path_segment(column):
+    '''SQL expression formatting an id column with PATH_DIGITS digits.'''
+    if db.session.connection().dialect.name == 'sqlite':
+        padding = '0' * PATH_DIGITS
+        return func.substr(padding + cast(column, String), -PATH_DIGITS)
+    return func.lpad(cast(column, String), PATH_DIGITS, '0')
+
+
+@db.event.listens_for(Comment, 'after_insert')
+def set_comment_path(mapper, connection, target):
+    '''Set the path of a new comment: the path of its parent plus its id.
+    The attribute is loaded from the DB when accessed.'''
+    comments = Comment.__table__
+    segment = '%0*d' % (PATH_DIGITS, target.id)
+    if target.parent_id is None:
+        path = segment
+    else:
+        parents = comments.alias('parent')
+        path = (select([parents.c.path])
+                .where(parents.c.id == target.parent_id)
+                .as_scalar()) + segment
+    connection.execute(comments.update()
+                       .where(comments.c.id == target.id)
+                       .values(path=path))
+
+
+def build_paths(rebuild=False):
+    '''Set the paths of the comments without one, a level of the threads at
+    a time. If rebuild, recompute all the paths. Doesn't commit.'''
+    comments = Comment.__table__
+    if rebuild:
+        db.session.execute(comments.update().values(path=None))
+    db.session.execute(comments.update()
+                       .where(comments.c.parent_id.is_(None))
+                       .where(comments.c.path.is_(None))
+                       .values(path=path_segment(comments.c.id)))
+    parents = comments.alias('parent')
+    parent_path = (select([parents.c.path])
+                   .where(parents.c.id == comments.c.parent_id)
+                   .as_scalar())
+    with_path = (select([parents.c.id])
+                 .where(parents.c.path.isnot(None)))
+    while True:
+        updated = db.session.execute(
+            comments.update()
+            .where(comments.c.path.is_(None))
+            .where(comments.c.parent_id.in_(with_path))
+            .values(path=parent_path + path_segment(comments.c.id))
+        ).rowcount
+        if not updated:
+            break
+
+
+# Backs subtree queries (path LIKE 'prefix%')
+db.Index('ix_comment_path', Comment.path,
+         postgresql_ops={'path': 'text_pattern_ops'})
+
+# Back the pages of a thread, by creation time and by score, and the top
+# comments of threads
+db.Index('ix_comment_thread_parent_created',
+         Comment.thread_id, Comment.parent_id, Comment.created)
+db.Index('ix_comment_thread_parent_score',
+         Comment.thread_id, Comment.parent_id, Comment.score, Comment.id)
+db.Index('ix_comment_thread_score', Comment.thread_id, Comment.score)
+
+# Replies of a comment, comments and votes of an author
+db.Index('ix_comment_parent_id', Comment.parent_id)
+db.Index('ix_comment_author_id', Comment.author_id)
+db.Index('ix_votes_author_id', Vote.author_id)
+
+
+class Report(db.Model):
+    '''Outbox of report e-mails, sent by a background worker.
+    Reports of a comment are coalesced while the e-mail is not sent.'''
+    __tablename__ = 'report'
+    id = db.Column(db.Integer, primary_key=True)
+    # Not a foreign key: the comment may be deleted before the e-mail is sent
+    comment_id = db.Column(db.Integer, nullable=False, index=True)
+    delete_link = db.Column(db.Text(), nullable=False)
+    reports = db.Column(db.Integer, nullable=False, default=1)
+    created = db.Column(ArrowType, nullable=False)
+    next_attempt = db.Column(ArrowType, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(ArrowType, nullable=True)
+    last_error = db.Column(db.Text(), nullable=True)
+    # Lease of the worker sending the e-mail, see Outbox.claim
+    claimed_until = db.Column(ArrowType, nullable=True)
+
+    @classmethod
+    def add(cls, comment_id, delete_link, delay, max_attempts):
+        '''Report a comment, to be sent after delay seconds. Joins a report
+        of the same comment still to be sent (not being sent now, nor given
+        up after max_attempts), if any. Doesn't commit.'''
+        reports = cls.__table__
+        now = arrow.utcnow()
+        coalesced = db.session.execute(
+            reports.update()
+            .where(reports.c.comment_id == comment_id)
+            .where(reports.c.sent.is_(None))
+            .where(reports.c.attempts < max_attempts)
+            .where(or_(reports.c.claimed_until.is_(None),
+                       reports.c.claimed_until < now))
+            .values(reports=reports.c.reports + 1)).rowcount
+        if not coalesced:
+            db.session.add(cls(comment_id=comment_id, delete_link=delete_link,
+                               created=now,
+                               next_attempt=now.replace(seconds=+delay)))
+
+
+# Backs the search for the e-mails due (only the ones not sent are indexed)
+db.Index('ix_report_pending', Report.next_attempt,
+         postgresql_where=Report.sent.is_(None))
 
 
 class Thread(db.Model):
@@ -80,6 +499,77 @@ class Thread(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False, unique=True)
     comments = db.relationship("Comment", backref="thread")
+    # Denormalized, see update_thread_activity
+    comment_count = db.Column(db.Integer, nullable=False, default=0,
+                              server_default=db.text('0'))
+    last_activity = db.Column(ArrowType, nullable=True)
+    # Bumped by every change of its comments, including votes
+    version = db.Column(db.Integer, nullable=False, default=0,
+                        server_default=db.text('0'))
+
+
+def update_thread_activity(thread_id, comments_added=0, connection=None):
+    '''Add comments_added (may be negative) to the comment counter of a
+    thread, setting its last activity to now and bumping its version.
+    Doesn't commit.'''
+    threads = Thread.__table__
+    (connection or db.session).execute(
+        threads.update()
+        .where(threads.c.id == thread_id)
+        .values(comment_count=threads.c.comment_count + comments_added,
+                last_activity=arrow.utcnow(),
+                version=threads.c.version + 1))
+
+
+def thread_version(thread_id):
+    '''Return the version of a thread. Read in the transaction of a change,
+    after it, this is the version the change created: the row of the thread
+    stays locked until the commit, so no other change can bump it.'''
+    return db.session.query(Thread.version).filter_by(id=thread_id).scalar()
+
+
+def bump_thread_versions(comment_ids=None, id_range=None):
+    '''Bump the versions of the threads of the comments (of all threads, if
+    comment_ids and id_range (first, last + 1) are None), e.g. after their
+    votes change. Doesn't commit.'''
+    threads = Thread.__table__
+    comments = Comment.__table__
+    query = threads.update().values(version=threads.c.version + 1)
+    of_comments = select([comments.c.thread_id])
+    if comment_ids is not None:
+        of_comments = of_comments.where(comments.c.id.in_(comment_ids))
+    if id_range is not None:
+        of_comments = of_comments.where(
+            comments.c.id.between(id_range[0], id_range[1] - 1))
+    if comment_ids is not None or id_range is not None:
+        query = query.where(threads.c.id.in_(of_comments))
+    db.session.execute(query)
+
+
+@db.event.listens_for(Comment, 'after_insert')
+def count_new_comment(mapper, connection, target):
+    '''Count a new comment in its thread.'''
+    update_thread_activity(target.thread_id, 1, connection)
+
+
+def recount_threads(id_range=None, thread_ids=None):
+    '''Rebuild comment_count and last_activity of the threads from their
+    comments, in one statement. Rebuilds all threads if id_range (first,
+    last + 1) and thread_ids are None. Doesn't commit.'''
+    threads = Thread.__table__
+    comments = Comment.__table__
+    of_thread = comments.c.thread_id == threads.c.id
+    query = threads.update().values(
+        comment_count=select([func.count()]).where(of_thread).as_scalar(),
+        last_activity=(select([func.max(comments.c.modified)])
+                       .where(of_thread).as_scalar()),
+        version=threads.c.version + 1)
+    if id_range is not None:
+        query = query.where(threads.c.id.between(id_range[0],
+                                                 id_range[1] - 1))
+    if thread_ids is not None:
+        query = query.where(threads.c.id.in_(thread_ids))
+    db.session.execute(query)
 
 
 class Author(db.Model):
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import time
+import threading
+
+import arrow
+from flask.ext.mail import Message
+from sqlalchemy import or_
+
+from models import Comment, Report
+from extensions import db, writing
+
+
+class Outbox(object):
+    '''Sends the report e-mails stored in the report table, with a pool of
+    background threads. Failed e-mails are retried with exponential
+    backoff.'''
+
+    def __init__(self):
+        self.app = None
+        self.mail = None
+        self.threads = []
+
+    def init_app(self, app, mail):
+        '''Configure from the OUTBOX_* settings. Workers are started with
+        the first request, so manage.py commands don't start them.'''
+        self.app = app
+        self.mail = mail
+        self.workers = app.config.get('OUTBOX_WORKERS', 1)
+        self.interval = app.config.get('OUTBOX_INTERVAL', 5)
+        self.backoff = app.config.get('OUTBOX_BACKOFF', 30)
+        self.lease = app.config.get('OUTBOX_LEASE', 600)
+        self.max_attempts = app.config.get('OUTBOX_MAX_ATTEMPTS', 8)
+        app.before_first_request(self.start)
+
+    def start(self):
+        '''Start the worker threads.'''
+        for i in range(self.workers - len(self.threads)):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        '''Send e-mails forever, sleeping while there are none due.'''
+        while True:
+            try:
+                with self.app.app_context():
+                    processed = self.send_due()
+            except Exception:
+                self.app.logger.exception('Error sending report e-mails')
+                processed = 0
+            if not processed:
+                time.sleep(self.interval)
+
+    def send_due(self, limit=10):
+        '''Send the e-mails due. Returns how many were processed.'''
+        now = arrow.utcnow()
+        due = (db.session.query(Report.id)
+               .filter(Report.sent.is_(None))
+               .filter(Report.attempts < self.max_attempts)
+               .filter(Report.next_attempt <= now)
+               .filter(or_(Report.claimed_until.is_(None),
+                           Report.claimed_until < now))
+               .order_by(Report.next_attempt)
+               .limit(limit)
+               .all())
+        # Don't hold the read transaction while sending
+        db.session.commit()
+        processed = 0
+        for report_id, in due:
+            if self.claim(report_id):
+                self.send(db.session.query(Report).get(report_id))
+                processed += 1
+        return processed
+
+    def claim(self, report_id):
+        '''Lease a report for OUTBOX_LEASE seconds, so other workers (even
+        in other processes) skip it while it is being sent, and new reports
+        aren't joined to it. Returns if it was claimed.'''
+        reports = Report.__table__
+        now = arrow.utcnow()
+        claimed = db.session.execute(
+            reports.update()
+            .where(reports.c.id == report_id)
+            .where(or_(reports.c.claimed_until.is_(None),
+                       reports.c.claimed_until < now))
+            .values(claimed_until=now.replace(seconds=+self.lease))
+        ).rowcount
+        db.session.commit()
+        return bool(claimed)
+
+    def send(self, report):
+        '''Send the e-mail of a report, scheduling a retry if it fails.
+        No transaction is open while talking to the SMTP server.'''
+        comment = db.session.query(Comment).get(report.comment_id)
+        if comment is None:
+            # Already deleted, nothing to report
+            with writing():
+                report.claimed_until = None
+                report.sent = arrow.utcnow()
+                db.session.commit()
+            return
+        config = self.app.config
+        msg = Message(
+            'Request to delete comment: %s' % comment.id,
+            sender=config['SENDER_NAME'],
+            recipients=config['ADMIN_EMAILS'])
+        msg.body = config['EMAIL_TEMPLATE'].format(
+            delete_link=report.delete_link,
+            id=comment.id,
+            author=comment.author.name,
+            thread=comment.thread.name,
+            created=comment.created,
+            modified=comment.modified,
+            text=comment.text,
+            reports=report.reports,
+        )
+        report_id = report.id
+        db.session.commit()
+        error = None
+        try:
+            self.mail.send(msg)
+        except Exception as e:
+            error = e
+            self.app.logger.warning('Error sending report %s: %s',
+                                    report_id, e)
+        with writing():
+            report.claimed_until = None
+            if error is None:
+                report.sent = arrow.utcnow()
+            else:
+                report.attempts += 1
+                report.last_error = '%s' % error
+                delay = self.backoff * 2 ** report.attempts
+                report.next_attempt = arrow.utcnow().replace(seconds=+delay)
+            db.session.commit()
+
+
+outbox = Outbox()
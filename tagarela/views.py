@@ -4,19 +4,32 @@
 from __future__ import unicode_literals  # unicode by default
 
 # import pytz
+import json
+import hashlib
+import numbers
+
 import arrow
 import bleach
-from sqlalchemy import desc
+from sqlalchemy import desc, func
 from sqlalchemy.orm.exc import NoResultFound
+from arrow.parser import ParserError
+from flask import request, Response, stream_with_context
+from flask.ext.restful import inputs
 from flask.ext.restplus import Resource
-from flask.ext.mail import Message
 from itsdangerous import BadSignature, SignatureExpired
 
 from viralata.utils import decode_token
-from cutils import date_to_json, paginate, ExtraApi
+from cutils import (date_to_json, select_related, paginate, paginate_keyset,
+                    count_total, encode_cursor, decode_cursor, make_etag,
+                    conditional_response, ExtraApi)
 
-from models import Comment, Thread, Author
-from extensions import db, sv
+from models import (Comment, Thread, Author, Report, get_id_add_if_needed,
+                    delete_comments, update_thread_activity, thread_version)
+from extensions import db, sv, thread_cache, token_cache, replica
+from votebuffer import vote_buffer
+from events import events, format_event
+from outbox import outbox
+from instrumentation import instrumentation
 
 
 api = ExtraApi(version='1.0',
@@ -34,76 +47,269 @@ api.update_parser_arguments({
         'type': bool,
         'help': 'Use "true" for a upvote, "false" for a downvote.',
     },
+    'stream': {
+        'location': 'args',
+        'type': inputs.boolean,
+        'default': False,
+        'help': 'Stream the JSON while it is generated. Uses less memory '
+        'for very large threads.',
+    },
+    'name': {
+        'location': 'args',
+        'action': 'append',
+        'help': 'Name of a thread. Repeat for each thread.',
+    },
+    'top': {
+        'location': 'args',
+        'type': int,
+        'default': 0,
+        'help': 'Number of top comments (by score) to return for each '
+        'thread.',
+    },
+    'limit': {
+        'location': 'args',
+        'type': int,
+        'help': 'Max number of root comments to return (or of replies, if '
+        'a "replies_cursor" is used). Default: 50. Larger values are '
+        'lowered to a maximum set by the server.',
+    },
+    'sort': {
+        'location': 'args',
+        'choices': ('newest', 'oldest', 'top'),
+        'help': 'Order of the comments (and replies). "top" is by score, '
+        'which ranks comments by their votes. Default: "oldest" for the '
+        'pages of a thread, "newest" for the list of comments.',
+    },
+    'max_depth': {
+        'location': 'args',
+        'type': int,
+        'help': 'Replies deeper than this are collapsed.',
+    },
+    'replies_limit': {
+        'location': 'args',
+        'type': int,
+        'help': 'Max number of replies returned for each comment. The '
+        'others are collapsed. Default and maximum set by the server.',
+    },
+    'response': {
+        'default': 'full',
+        'choices': ('minimal', 'delta', 'full'),
+        'help': 'What to return after a change: "minimal" (only the '
+        'affected comment, without replies), "delta" (the changed comments '
+        'and the new version of the thread) or "full" (the whole thread).',
+    },
 })
 
 
 @api.route('/thread/<string:thread_name>')
 class ThreadAPI(Resource):
 
+    @api.doc(parser=api.create_parser('stream', 'limit', 'cursor', 'sort',
+                                      'max_depth', 'replies_limit'))
     def get(self, thread_name):
-        '''Get comments from a thread.'''
-        return get_thread_comments(thread_name=thread_name)
-
-    @api.doc(parser=api.create_parser('token', 'text'))
+        '''Get comments from a thread.
+        If any of limit, cursor, sort, max_depth or replies_limit are used,
+        returns
+        a page of the thread: collapsed replies have a "more_replies" count
+        and a "replies_cursor" to fetch them.
+        Supports conditional requests with If-None-Match.'''
+        args = api.general_parse()
+        page_args = [args[arg] for arg in
+                     ('limit', 'cursor', 'sort', 'max_depth', 'replies_limit')]
+        last_modified, count, version = (
+            replica.reads().query(func.max(Comment.modified),
+                                  func.count(Comment.id),
+                                  func.max(Thread.version))
+            .join(Thread, Comment.thread_id == Thread.id)
+            .filter(Thread.name == thread_name)
+            .one())
+        # The version changes with any write, even votes that cancel out.
+        # Streamed and built bodies differ in whitespace: vary by stream.
+        # No Last-Modified: votes and deletes don't move the dates forward.
+        etag = make_etag(thread_name, last_modified, count, version,
+                         args['stream'], *page_args)
+        headers, not_modified = conditional_response(etag)
+        if not_modified:
+            return not_modified
+        if any(arg is not None for arg in page_args):
+            page = get_thread_page(thread_name, count, *page_args)
+            return page, 200, headers
+        if args['stream']:
+            return Response(
+                stream_with_context(stream_thread_comments(thread_name)),
+                mimetype='application/json', headers=headers)
+        return get_thread_comments(thread_name=thread_name), 200, headers
+
+    @api.doc(parser=api.create_parser('token', 'text', 'response'))
     def post(self, thread_name):
         '''Add a comment to thread.'''
         args, author_name = parse_and_decode()
 
         text = bleach.clean(args['text'], strip=True)
 
-        # Get thread (add if needed)
-        try:
-            thread = (db.session.query(Thread)
-                      .filter(Thread.name == thread_name).one())
-        except NoResultFound:
-            thread = Thread(name=thread_name)
-            db.session.add(thread)
-            db.session.commit()
-
+        thread_id = get_id_add_if_needed(Thread, thread_name)
         author_id = get_author_add_if_needed(author_name)
 
         now = arrow.utcnow()
-        comment = Comment(author_id=author_id, text=text, thread_id=thread.id,
+        comment = Comment(author_id=author_id, text=text, thread_id=thread_id,
                           created=now, modified=now)
         db.session.add(comment)
+        db.session.flush()
+        version = thread_version(thread_id)
         db.session.commit()
-        return get_thread_comments(thread)
+        thread_cache.invalidate(thread_name)
+        publish_changes('comment', thread_name, version, changed=[comment])
+        return write_response(args['response'], thread_name, version,
+                              changed=[comment])
+
+
+@api.route('/thread/<string:thread_name>/events')
+class ThreadEventsAPI(Resource):
+
+    def get(self, thread_name):
+        '''Stream the changes of a thread as Server-Sent Events.
+        Events: "comment" (new comments), "edit" (edited comments), "delete"
+        (deleted ids and hidden comments), "votes" (new counters of
+        comments) and "reset" (events were lost: get the thread again).
+        Event ids are versions of the thread.'''
+        if not events.enabled:
+            api.abort(404, 'Events are disabled')
+        last_event_id = request.headers.get('Last-Event-ID')
+        return Response(
+            stream_with_context(stream_events(thread_name, last_event_id)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache',
+                     'X-Accel-Buffering': 'no'})
+
+
+@api.route('/threads')
+class ThreadSummaryAPI(Resource):
+
+    @api.doc(parser=api.create_parser('name', 'top'))
+    def get(self):
+        '''Get the comment count and last activity of many threads at once,
+        optionally with their top comments.'''
+        args = api.general_parse()
+        names = args['name'] or []
+        top = args['top']
+        if len(names) > 100:
+            api.abort(400, 'Too many threads (max: 100)')
+        session = replica.reads()
+
+        summaries = dict((name, {
+            'name': name,
+            'count': 0,
+            'last_activity': None,
+            'top': [],
+        }) for name in names)
+        threads = (session.query(Thread.name, Thread.comment_count,
+                                 Thread.last_activity)
+                   .filter(Thread.name.in_(names)))
+        for name, count, last_activity in threads:
+            summaries[name]['count'] = count
+            if last_activity is not None:
+                summaries[name]['last_activity'] = date_to_json(last_activity)
+
+        if names and top > 0:
+            ranked = (session.query(
+                Comment.id,
+                func.row_number().over(
+                    partition_by=Comment.thread_id,
+                    order_by=(desc(Comment.score),
+                              desc(Comment.id))).label('rank'))
+                .join(Thread)
+                .filter(Thread.name.in_(names))
+                .filter(Comment.hidden.is_(False))
+                .subquery())
+            rows = (select_related(session, Comment, thread_name=Thread.name,
+                                   author=Author.name)
+                    .join(ranked, ranked.c.id == Comment.id)
+                    .filter(ranked.c.rank <= top)
+                    .order_by(ranked.c.rank)
+                    .all())
+            with instrumentation.timed('serialize_seconds_total'):
+                urls = comment_url_templates()
+                for c, author_name, thread_name in rows:
+                    node = comment_to_dict(c, author_name, urls)
+                    del node['replies']
+                    summaries[thread_name]['top'].append(node)
+
+        return {'threads': [summaries[name] for name in names]}
 
 
 @api.route('/comment')
 class ListCommentsAPI(Resource):
 
-    @api.doc(parser=api.create_parser('page', 'per_page_num'))
+    @api.doc(parser=api.create_parser('page', 'per_page_num', 'cursor',
+                                      'total', 'sort'))
     def get(self):
-        '''List comments by decrescent creation time.'''
+        '''List visible comments, by default the newest first.
+        Returns a "next" cursor, to be used instead of "page" for faster
+        pagination (it keeps the sort of its first page).
+        Supports conditional requests with If-None-Match.'''
         args = api.general_parse()
         page = args['page']
         per_page_num = args['per_page_num']
-        comments = (db.session.query(Comment, Thread.name)
-                    .filter(Comment.thread_id == Thread.id)
-                    .order_by(desc(Comment.created))
-                    .filter_by(hidden=False))
+        cursor = args['cursor']
+        sort = args['sort'] or 'newest'
+
+        if cursor:
+            sort, after = decode_page_cursor(cursor)
+        columns, descending = THREAD_SORTS[sort]
+        comments = (select_related(replica.reads(), Comment,
+                                   thread_name=Thread.name,
+                                   author=Author.name)
+                    .order_by(*[desc(c) if descending else c
+                                for c in columns])
+                    .filter(Comment.hidden.is_(False)))
         # Limit que number of results per page
-        comments, total = paginate(comments, page, per_page_num)
-        return {
-            'comments': [
+        if cursor:
+            total = count_total(comments, args['total'])
+            comments, has_more = paginate_keyset(
+                comments, columns, after, per_page_num, descending)
+        else:
+            comments, total = paginate(comments, page, per_page_num,
+                                       args['total'])
+            has_more = len(comments) == per_page_num
+
+        if comments and has_more:
+            next_cursor = encode_cursor(
+                sort, thread_sort_key(comments[-1].Comment, sort))
+        else:
+            next_cursor = None
+
+        # The page is cheap to fetch (by index), so the validator is built
+        # from it instead of from the whole table
+        etag = make_etag(page, per_page_num, cursor, args['total'], sort,
+                         total, next_cursor,
+                         *[(row.Comment.id, row.Comment.modified,
+                            row.Comment.score) for row in comments])
+        headers, not_modified = conditional_response(etag, None)
+        if not_modified:
+            return not_modified
+
+        with instrumentation.timed('serialize_seconds_total'):
+            nodes = [
                 {
-                    'thread_name': thread_name,
-                    'id': c.id,
-                    'text': c.text,
-                    'author': c.author.name,
-                    'created': date_to_json(c.created),
-                    'modified': date_to_json(c.modified),
+                    'thread_name': row.thread_name,
+                    'id': row.Comment.id,
+                    'text': row.Comment.text,
+                    'author': row.author,
+                    'created': date_to_json(row.Comment.created),
+                    'modified': date_to_json(row.Comment.modified),
                     # 'url': api.url_for(CommentAPI, comment_id=c.id),
-                } for c, thread_name in comments],
+                } for row in comments]
+        return {
+            'comments': nodes,
             'total': total,
-        }
+            'next': next_cursor,
+        }, 200, headers
 
 
 @api.route('/comment/<int:comment_id>')
 class CommentAPI(Resource):
 
-    @api.doc(parser=api.create_parser('token', 'text'))
+    @api.doc(parser=api.create_parser('token', 'text', 'response'))
     def post(self, comment_id):
         '''Add a comment reply to this comment.'''
         args, author_name = parse_and_decode()
@@ -119,33 +325,66 @@ class CommentAPI(Resource):
                           created=now, modified=now,
                           parent_id=parent.id)
         db.session.add(comment)
+        db.session.flush()
+        version = thread_version(parent.thread_id)
         db.session.commit()
-        return get_thread_comments(comment.thread)
+        thread_name = comment.thread.name
+        thread_cache.invalidate(thread_name)
+        publish_changes('comment', thread_name, version, changed=[comment])
+        return write_response(args['response'], thread_name, version,
+                              changed=[comment])
 
-    @api.doc(parser=api.create_parser('token'))
+    @api.doc(parser=api.create_parser('token', 'response'))
     def delete(self, comment_id):
         '''Delete a comment from a thread. Returns thread.'''
         args, author_name = parse_and_decode()
         comment = check_comment_author(comment_id, author_name)
-        thread = comment.thread
-        delete_comment(comment)
-        return get_thread_comments(thread)
-
-    @api.doc(parser=api.create_parser('token', 'text'))
+        thread_name = comment.thread.name
+        deleted, version = delete_comment(comment)
+        thread_cache.invalidate(thread_name)
+        changed = [] if deleted else [comment]
+        publish_changes('delete', thread_name, version, changed, deleted)
+        return write_response(args['response'], thread_name, version,
+                              changed=changed, deleted=deleted)
+
+    @api.doc(parser=api.create_parser('token', 'text', 'response'))
     def put(self, comment_id):
         '''Edit a comment in a thread.'''
         args, author_name = parse_and_decode()
         comment = check_comment_author(comment_id, author_name)
         comment.text = args['text']
         comment.modified = arrow.utcnow()
+        update_thread_activity(comment.thread_id)
+        version = thread_version(comment.thread_id)
         db.session.commit()
-        return get_thread_comments(comment.thread)
+        thread_name = comment.thread.name
+        thread_cache.invalidate(thread_name)
+        publish_changes('edit', thread_name, version, changed=[comment])
+        return write_response(args['response'], thread_name, version,
+                              changed=[comment])
+
+
+@api.route('/comment/<int:comment_id>/subtree')
+class SubtreeAPI(Resource):
+
+    def get(self, comment_id):
+        '''Get a comment with all its replies, its depth and the ids of its
+        ancestors (from the root).'''
+        comment = get_comment(comment_id)
+        rows = (select_related(db.session, Comment, author=Author.name)
+                .filter(Comment.path.like(comment.path + '%'))
+                .order_by(Comment.path)
+                .all())
+        node = build_comment_tree(rows)[0]
+        node['depth'] = comment.depth
+        node['ancestors'] = comment.ancestor_ids
+        return node
 
 
 @api.route('/vote/<int:comment_id>')
 class VoteAPI(Resource):
 
-    @api.doc(parser=api.create_parser('token', 'vote'))
+    @api.doc(parser=api.create_parser('token', 'vote', 'response'))
     def post(self, comment_id):
         '''Like/dislike a comment in a thread.
         If vote is False, dislike; else like.'''
@@ -155,8 +394,19 @@ class VoteAPI(Resource):
         comment = get_comment(comment_id)
         if comment.author_id == author_id:
             api.abort(400, 'You cannot vote for your own comments...')
+        if vote_buffer.enabled:
+            # Counters will be updated by the next flush of the buffer
+            db.session.commit()  # the author may have been added
+            vote_buffer.add(comment.id, author_id, vote)
+            return {'message': 'Vote received!'}, 202
         comment.set_vote(author_id, vote)
-        return get_thread_comments(comment.thread)
+        version = thread_version(comment.thread_id)
+        db.session.commit()
+        thread_name = comment.thread.name
+        thread_cache.invalidate(thread_name)
+        events.publish(thread_name, 'votes', version, [vote_counts(comment)])
+        return write_response(args['response'], thread_name, version,
+                              changed=[comment])
 
 
 @api.route('/report/<int:comment_id>')
@@ -164,25 +414,16 @@ class ReportAPI(Resource):
 
     def post(self, comment_id):
         '''Report comment for possible delete.
-        An e-mail will be sent to admins with a link to delete the comment.'''
+        An e-mail will be sent to admins with a link to delete the comment.
+        Reports of the same comment are joined in a single e-mail.'''
         comment = get_comment(comment_id)
         token = api.urltoken.dumps((comment.id, comment.thread.name))
         suburl = api.url_for(DeleteReportedAPI, token=token)
         delete_link = api.app.config['HOSTED_ADDRESS'] + suburl
-        msg = Message(
-            'Request to delete comment: %s' % comment.id,
-            sender=api.app.config['SENDER_NAME'],
-            recipients=api.app.config['ADMIN_EMAILS'])
-        msg.body = api.app.config['EMAIL_TEMPLATE'].format(
-            delete_link=delete_link,
-            id=comment.id,
-            author=comment.author.name,
-            thread=comment.thread.name,
-            created=comment.created,
-            modified=comment.modified,
-            text=comment.text,
-        )
-        api.mail.send(msg)
+        Report.add(comment.id, delete_link,
+                   api.app.config.get('REPORT_DIGEST_DELAY', 60),
+                   outbox.max_attempts)
+        db.session.commit()
         return {'message': 'Reported!'}
 
 
@@ -203,59 +444,361 @@ class DeleteReportedAPI(Resource):
         comment = get_comment(comment_id)
         if comment.thread.name != thread_name:
             api.abort(400, 'Thread name mismatch')
-        delete_comment(comment)
+        deleted, version = delete_comment(comment)
+        thread_cache.invalidate(thread_name)
+        publish_changes('delete', thread_name, version,
+                        [] if deleted else [comment], deleted)
         return {'message': 'Deleted!'}
 
 
-def comment_to_dict(c):
-    '''Return a comment as a dict (recursively including children).'''
+# URL templates of the links of comments, by script root
+url_templates = {}
+
+
+def comment_url_templates():
+    '''Return the templates of the URLs linked from comments ("url",
+    "vote_url" and "report_url"), to be formatted with the comment id.
+    They are built with api.url_for only once, instead of for each comment.'''
+    templates = url_templates.get(request.script_root)
+    if templates is None:
+        templates = {}
+        for key, resource in (('url', CommentAPI),
+                              ('vote_url', VoteAPI),
+                              ('report_url', ReportAPI)):
+            # All these URLs end with the comment id
+            url = api.url_for(resource, comment_id=0)
+            templates[key] = url[:-1].replace('%', '%%') + '%d'
+        url_templates[request.script_root] = templates
+    return templates
+
+
+def comment_to_dict(c, author_name, urls=None):
+    '''Return a comment as a dict, with an empty list of replies.
+    Doesn't touch relationships, so no lazy loads are triggered.
+    urls are the templates from comment_url_templates.'''
+    if urls is None:
+        urls = comment_url_templates()
+    created = date_to_json(c.created)
+    if c.modified == c.created:
+        modified = created
+    else:
+        modified = date_to_json(c.modified)
     return {
         'id': c.id,
         'text': c.text,
-        'author': c.author.name,
-        'created': date_to_json(c.created),
-        'modified': date_to_json(c.modified),
+        'author': author_name,
+        'created': created,
+        'modified': modified,
         'upvotes': c.likes,
         'downvotes': c.dislikes,
         'hidden': c.hidden,
-        'url': api.url_for(CommentAPI, comment_id=c.id),
-        'vote_url': api.url_for(VoteAPI, comment_id=c.id),
-        'report_url': api.url_for(ReportAPI, comment_id=c.id),
-        'replies': [] if c.children is None else [
-            comment_to_dict(child)
-            for child in c.children
-        ]
+        'url': urls['url'] % c.id,
+        'vote_url': urls['vote_url'] % c.id,
+        'report_url': urls['report_url'] % c.id,
+        'replies': [],
     }
 
 
+def build_comment_tree(rows):
+    '''Link (comment, author_name) rows by parent_id, in O(n).
+    Returns the list of root comments as dicts (with nested replies). Roots
+    are the comments whose parent is not among the rows.'''
+    with instrumentation.timed('serialize_seconds_total'):
+        urls = comment_url_templates()
+        nodes = {}
+        for c, author_name in rows:
+            nodes[c.id] = comment_to_dict(c, author_name, urls)
+        roots = []
+        for c, author_name in rows:
+            if c.parent_id not in nodes:
+                roots.append(nodes[c.id])
+            else:
+                nodes[c.parent_id]['replies'].append(nodes[c.id])
+    return roots
+
+
+def write_response(mode, thread_name, version, changed=(), deleted=()):
+    '''Return the response for a write that made a thread reach version.
+    changed are the comments added or modified, deleted the ids of the
+    removed ones. mode is the "response" argument: "minimal" returns only the
+    first affected comment, "delta" all of them, "full" the whole thread.'''
+    if mode == 'full':
+        return get_thread_comments(thread_name=thread_name)
+
+    nodes = comment_nodes(changed, deleted)
+    if mode == 'minimal':
+        return nodes[0]
+    return {
+        'comments': nodes,
+        'name': thread_name,
+        'version': version,
+    }
+
+
+def comment_nodes(changed=(), deleted=()):
+    '''Return changed comments as dicts (without replies), followed by the
+    ids of the deleted ones, marked as such.'''
+    nodes = []
+    with instrumentation.timed('serialize_seconds_total'):
+        for c in changed:
+            node = comment_to_dict(c, c.author.name)
+            del node['replies']
+            nodes.append(node)
+        nodes.extend({'id': comment_id, 'deleted': True}
+                     for comment_id in deleted)
+    return nodes
+
+
+def vote_counts(c):
+    '''Return the vote counters of a comment, as sent in "votes" events.'''
+    return {'id': c.id, 'upvotes': c.likes, 'downvotes': c.dislikes}
+
+
+def publish_changes(event, thread_name, version, changed=(), deleted=()):
+    '''Send the changed and deleted comments of a thread to the subscribers
+    of its events.'''
+    if events.enabled:
+        events.publish(thread_name, event, version,
+                       comment_nodes(changed, deleted))
+
+
+def stream_events(thread_name, last_event_id=None):
+    '''Yield the events of a thread in the text/event-stream format, with
+    comment lines as heartbeats, until the client goes away.
+    A client reconnecting after missing some writes gets a "reset".'''
+    subscription = events.subscribe(thread_name)
+    try:
+        version = (db.session.query(Thread.version)
+                   .filter_by(name=thread_name).scalar() or 0)
+        # Don't hold a DB connection for as long as the client is connected
+        db.session.remove()
+        if last_event_id is not None and last_event_id != str(version):
+            yield format_event({'event': 'reset', 'id': version})
+        else:
+            yield ': connected\n\n'
+        while True:
+            message = subscription.get(events.heartbeat)
+            if message is None:
+                yield ': heartbeat\n\n'
+            else:
+                yield format_event(message)
+    finally:
+        subscription.close()
+
+
 def get_thread_comments(thread=None, thread_name=None):
     '''Return the comments of a thread.
-    May receive a thread object or the name of a thread.'''
-    if thread_name:
-        try:
-            thread = (db.session.query(Thread)
-                      .filter(Thread.name == thread_name)
-                      .options(db.joinedload('comments.author'),
-                               db.joinedload('comments.children'))
-                      .one())
-        except NoResultFound:
-            comments = []
-            count = 0
-            # api.abort(404)
-
+    May receive a thread object or the name of a thread.
+    All comments and their authors are fetched in a single query, unless
+    the current version of the thread is cached.'''
     if thread:
-        comments = [comment_to_dict(c) for c in thread.comments
-                    if c.parent_id is None]
         thread_name = thread.name
-        count = len(thread.comments)
+
+    # Read the version before querying, so a write that happens meanwhile
+    # makes this payload stale instead of being hidden by it
+    version = thread_cache.version(thread_name)
+    cached = thread_cache.get(thread_name, version)
+    if cached is not None:
+        return cached
+
+    session = replica.reads()
+    rows = (select_related(session, Comment, author=Author.name)
+            .join(Thread)
+            .filter(Thread.name == thread_name)
+            .order_by(Comment.id)
+            .all())
+
+    payload = {
+        'comments': build_comment_tree(rows),
+        'name': thread_name,
+        'count': len(rows)
+    }
+    # A lagging replica could store an old payload as the current version
+    if session is db.session:
+        thread_cache.set(thread_name, version, payload)
+    return payload
+
+
+# Orders of thread pages and of the list of comments: (columns, descending)
+THREAD_SORTS = {
+    'newest': ((Comment.created, Comment.id), True),
+    'oldest': ((Comment.created, Comment.id), False),
+    'top': ((Comment.score, Comment.id), True),
+}
+
+
+def thread_sort_key(c, sort):
+    '''Return the values of a comment for a sort order, for cursors.'''
+    if sort == 'top':
+        return [c.score, c.id]
+    return [c.created.isoformat(), c.id]
+
+
+def decode_page_cursor(cursor, replies=False):
+    '''Decode a cursor of the list of comments, [sort, after], or of the
+    pages of a thread, [parent_id, sort, after], with after the sort key of
+    the last comment returned (or None). Aborts with 400 if it is malformed,
+    e.g. was tampered with. Returns its values, with the date of the key
+    parsed.'''
+    try:
+        values = decode_cursor(cursor)
+        if replies:
+            parent_id, sort, after = values
+            if not (parent_id is None or
+                    isinstance(parent_id, numbers.Integral)):
+                raise ValueError('Invalid parent')
+        else:
+            sort, after = values
+        if sort not in THREAD_SORTS:
+            raise ValueError('Invalid sort')
+        if after is not None:
+            key, comment_id = after
+            if not isinstance(comment_id, numbers.Integral):
+                raise ValueError('Invalid id')
+            key = float(key) if sort == 'top' else arrow.get(key)
+            after = [key, comment_id]
+    except (ValueError, TypeError, ParserError):
+        api.abort(400, 'Invalid cursor')
+    if replies:
+        return parent_id, sort, after
+    return sort, after
+
+
+def get_thread_page(thread_name, count, limit=None, cursor=None,
+                    sort='oldest', max_depth=None, replies_limit=None):
+    '''Return a page of the comments of a thread.
+    Pages the root comments (or the replies of a comment, if cursor is a
+    "replies_cursor") by sort, loading replies one level at a time, at most
+    replies_limit per comment, up to max_depth. Replies left out are counted
+    in "more_replies", with a "replies_cursor" to continue from.
+    limit and replies_limit are capped by THREAD_PAGE_MAX_LIMIT and
+    THREAD_PAGE_MAX_REPLIES, so pages stay bounded.'''
+    for value in (limit, max_depth, replies_limit):
+        if value is not None and value < 1:
+            api.abort(400, 'limit, max_depth and replies_limit must be '
+                      'positive')
+    config = api.app.config
+    limit = min(limit or 50, config.get('THREAD_PAGE_MAX_LIMIT', 200))
+    max_replies = config.get('THREAD_PAGE_MAX_REPLIES', 100)
+    replies_limit = min(replies_limit or max_replies, max_replies)
+    sort = sort or 'oldest'
+    parent_id, after = None, None
+    if cursor:
+        parent_id, sort, after = decode_page_cursor(cursor, replies=True)
+    columns, descending = THREAD_SORTS[sort]
+    order = [desc(c) if descending else c for c in columns]
+
+    session = replica.reads()
+    siblings = (select_related(session, Comment, author=Author.name)
+                .join(Thread)
+                .filter(Thread.name == thread_name)
+                .filter(Comment.parent_id == parent_id)
+                .order_by(*order))
+    rows, has_more = paginate_keyset(siblings, columns, after, limit,
+                                     descending)
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_cursor(parent_id, sort,
+                                    thread_sort_key(rows[-1][0], sort))
+
+    nodes = {}
+    comments = []
+    with instrumentation.timed('serialize_seconds_total'):
+        for c, author_name in rows:
+            nodes[c.id] = comment_to_dict(c, author_name)
+            comments.append(nodes[c.id])
+
+    depth = 1
+    frontier = list(nodes)
+    while frontier:
+        if max_depth is not None and depth >= max_depth:
+            # Collapse all the replies of this level
+            counts = (session.query(Comment.parent_id,
+                                    func.count(Comment.id))
+                      .filter(Comment.parent_id.in_(frontier))
+                      .group_by(Comment.parent_id))
+            for comment_id, total in counts:
+                nodes[comment_id]['more_replies'] = total
+                nodes[comment_id]['replies_cursor'] = encode_cursor(
+                    comment_id, sort, None)
+            break
+
+        # Rank the replies of each comment, keeping the first replies_limit
+        ranked = (session.query(
+            Comment.id,
+            func.row_number().over(partition_by=Comment.parent_id,
+                                   order_by=order).label('rank'),
+            func.count(Comment.id).over(
+                partition_by=Comment.parent_id).label('total'))
+            .filter(Comment.parent_id.in_(frontier))
+            .subquery())
+        replies = (select_related(session, Comment, author=Author.name)
+                   .add_columns(ranked.c.total)
+                   .join(ranked, ranked.c.id == Comment.id)
+                   .filter(ranked.c.rank <= replies_limit)
+                   .order_by(ranked.c.rank)
+                   .all())
+
+        frontier = []
+        last_replies = {}
+        with instrumentation.timed('serialize_seconds_total'):
+            for c, author_name, total in replies:
+                nodes[c.id] = comment_to_dict(c, author_name)
+                nodes[c.parent_id]['replies'].append(nodes[c.id])
+                frontier.append(c.id)
+                last_replies[c.parent_id] = (c, total)
+        for comment_id, (last, total) in last_replies.items():
+            node = nodes[comment_id]
+            if total > len(node['replies']):
+                node['more_replies'] = total - len(node['replies'])
+                node['replies_cursor'] = encode_cursor(
+                    comment_id, sort, thread_sort_key(last, sort))
+        depth += 1
 
     return {
         'comments': comments,
         'name': thread_name,
-        'count': count
+        'count': count,
+        'next': next_cursor,
     }
 
 
+def iter_thread_depth_first(thread_name, batch_size=500):
+    '''Yield (comment, author_name, depth) for the comments of a thread, in
+    depth first order, with siblings in the order of their ids.
+    Ordering by the materialized paths, with a server side cursor, so only
+    batch_size rows are in memory at a time.'''
+    rows = (select_related(replica.reads(), Comment, author=Author.name)
+            .join(Thread)
+            .filter(Thread.name == thread_name)
+            .order_by(Comment.path)
+            .yield_per(batch_size))
+    for c, author_name in rows:
+        yield c, author_name, c.depth
+
+
+def stream_thread_comments(thread_name):
+    '''Yield the JSON of get_thread_comments in chunks, as the comments are
+    fetched, without building the whole tree in memory.'''
+    yield '{"comments": ['
+    urls = comment_url_templates()
+    count = 0
+    previous_depth = -1
+    for c, author_name, depth in iter_thread_depth_first(thread_name):
+        # Close the replies of the nodes that are not ancestors of this one
+        if depth <= previous_depth:
+            yield ']}' * (previous_depth - depth + 1) + ', '
+        with instrumentation.timed('serialize_seconds_total'):
+            node = comment_to_dict(c, author_name, urls)
+            del node['replies']
+            chunk = json.dumps(node)[:-1] + ', "replies": ['
+        yield chunk
+        previous_depth = depth
+        count += 1
+    yield ']}' * (previous_depth + 1)
+    yield '], "name": %s, "count": %d}' % (json.dumps(thread_name), count)
+
+
 def get_comment(comment_id):
     '''Return a comment.'''
     try:
@@ -265,16 +808,8 @@ def get_comment(comment_id):
 
 
 def get_author_add_if_needed(author_name):
-    '''Get author id, adding if needed.'''
-    try:
-        author_id = (db.session.query(Author.id)
-                     .filter(Author.name == author_name).one())
-    except NoResultFound:
-        author = Author(name=author_name)
-        db.session.add(author)
-        db.session.commit()
-        author_id = author.id
-    return author_id
+    '''Get author id, adding if needed (without committing).'''
+    return get_id_add_if_needed(Author, author_name)
 
 
 def check_comment_author(comment_id, author_name):
@@ -289,22 +824,26 @@ def check_comment_author(comment_id, author_name):
 
 
 def parse_and_decode():
-    '''Return args and username'''
+    '''Return args and username.
+    Verified tokens are cached, so their signatures are not checked again.'''
     args = api.general_parse()
-    return args, decode_token(args['token'], sv, api)['username']
+    token = args['token']
+    if not token:
+        return args, decode_token(token, sv, api)['username']
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    username = token_cache.get(key)
+    if username is None:
+        decoded = decode_token(token, sv, api)
+        username = decoded['username']
+        token_cache.set(key, username, decoded.get('exp'))
+    return args, username
 
 
 def delete_comment(comment):
-    # If the comment has children, hide instead of deleting.
-    # (you wouldn't delete a comment with children, would you?)
-    if comment.children:
-        comment.hidden = True
-        comment.modified = arrow.utcnow()
-    else:
-        db.session.delete(comment)
-        # Remove hidden ancestors (this avoids leaving chidrenless comments
-        # hidden)
-        parent = comment.parent
-        if parent and parent.hidden:
-            delete_comment(parent)
+    '''Delete a comment, or hide it if it has replies, in one transaction.
+    Returns the ids of the deleted comments (empty if it was hidden) and the
+    version of the thread after the change.'''
+    deleted = delete_comments([comment.id])
+    version = thread_version(comment.thread_id)
     db.session.commit()
+    return deleted, version
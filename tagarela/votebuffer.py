@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import time
+import atexit
+import threading
+
+from models import Comment, Thread, apply_votes
+from extensions import db, thread_cache, writing
+from events import events
+
+
+class VoteBuffer(object):
+    '''Buffer of votes, applied to the DB in batches by a background thread.
+    Repeated votes of an author for a comment are coalesced (the last one
+    wins). Votes not flushed yet are lost if the process dies.'''
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.interval = 0.5
+        self.lock = threading.Lock()
+        self.votes = {}
+        self.thread = None
+
+    def init_app(self, app):
+        '''Configure from VOTE_BUFFER and VOTE_FLUSH_INTERVAL (in ms).'''
+        self.app = app
+        self.enabled = app.config.get('VOTE_BUFFER', False)
+        self.interval = app.config.get('VOTE_FLUSH_INTERVAL', 500) / 1000.
+        if self.enabled:
+            atexit.register(self.flush)
+
+    def add(self, comment_id, author_id, like):
+        '''Buffer a vote, starting the flusher if needed.'''
+        with self.lock:
+            self.votes[(comment_id, author_id)] = like
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        '''Flush the buffer periodically.'''
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Error flushing votes')
+
+    def flush(self):
+        '''Apply the buffered votes to the DB.'''
+        with self.lock:
+            votes, self.votes = self.votes, {}
+        if not votes:
+            return
+        with self.app.app_context(), writing():
+            try:
+                comment_ids = apply_votes(votes)
+                rows = []
+                if comment_ids:
+                    # Read before the commit, so the versions are the ones
+                    # these votes created
+                    rows = (db.session.query(Thread.name, Thread.version,
+                                             Comment.id, Comment.likes,
+                                             Comment.dislikes)
+                            .join(Comment)
+                            .filter(Comment.id.in_(comment_ids))
+                            .all())
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Keep the votes for the next flush, unless newer ones
+                # arrived meanwhile
+                with self.lock:
+                    for key, like in votes.items():
+                        self.votes.setdefault(key, like)
+                raise
+            counts = {}
+            versions = {}
+            for thread_name, version, comment_id, likes, dislikes in rows:
+                versions[thread_name] = version
+                counts.setdefault(thread_name, []).append({
+                    'id': comment_id,
+                    'upvotes': likes,
+                    'downvotes': dislikes,
+                })
+            for thread_name, thread_counts in counts.items():
+                thread_cache.invalidate(thread_name)
+                events.publish(thread_name, 'votes', versions[thread_name],
+                               thread_counts)
+
+
+vote_buffer = VoteBuffer()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import os
+import atexit
+import shutil
+import tempfile
+import unittest
+
+import arrow
+
+from tagarela import views, models
+from tagarela.models import Comment, Thread, Author, get_id_add_if_needed
+from tagarela.app import create_app
+from tagarela.extensions import db, thread_cache
+from tagarela.events import events
+
+
+# Settings of the shared app, for a temporary folder
+SETTINGS = {
+    'SECRET_KEY': 'test',
+    'HOSTED_ADDRESS': 'http://localhost',
+    'SENDER_NAME': 'test@localhost',
+    'ADMIN_EMAILS': ['test@localhost'],
+    'MAIL_SUPPRESS_SEND': True,
+    'OUTBOX_WORKERS': 0,
+}
+
+_app = None
+
+
+def shared_app():
+    '''Return the app of the tests, created on the first call: the API
+    can't be bound to another app, so all the tests share it.'''
+    global _app
+    if _app is not None:
+        return _app
+    folder = tempfile.mkdtemp(prefix='tagarela-test-')
+    atexit.register(shutil.rmtree, folder)
+    settings = dict(SETTINGS, SQLALCHEMY_DATABASE_URI=os.environ.get(
+        'TAGARELA_TEST_DB', 'sqlite:///' + os.path.join(folder, 'test.db')))
+    with open(os.path.join(folder, 'local_settings.py'), 'w') as f:
+        for name, value in sorted(settings.items()):
+            f.write('%s = %r\n' % (name, value))
+    # Not used, as authentication is faked
+    open(os.path.join(folder, 'keypub'), 'w').close()
+    _app = create_app(folder)
+    return _app
+
+
+class AppTestCase(unittest.TestCase):
+    '''Runs each test against an empty DB: a temporary SQLite file, or the
+    one in TAGARELA_TEST_DB (its tables are dropped!).
+    Authentication is faked: the token is the username.'''
+
+    # Settings of events and of the thread cache for the tests of a class
+    settings = {}
+
+    def setUp(self):
+        self.app = shared_app()
+        self.config = dict(self.app.config)
+        self.app.config.update(self.settings)
+        configure_extensions(self.app)
+
+        self.decode_token = views.decode_token
+        views.decode_token = lambda token, sv, api: {'username': token}
+        for cache in models.name_ids.values():
+            cache.clear()
+        self.context = self.app.app_context()
+        self.context.push()
+        db.drop_all()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        views.decode_token = self.decode_token
+        self.app.config.clear()
+        self.app.config.update(self.config)
+        configure_extensions(self.app)
+
+
+def configure_extensions(app):
+    '''Configure again the extensions that tests may change settings of.'''
+    events.init_app(app)
+    thread_cache.init_app(app)
+
+
+def add_thread(name, size, depth):
+    '''Add a thread with size comments, nested in chains of up to depth
+    replies. Returns the ids of the comments.'''
+    thread_id = get_id_add_if_needed(Thread, name)
+    author_id = get_id_add_if_needed(Author, 'author')
+    ids = []
+    parent_id = None
+    for i in range(size):
+        now = arrow.utcnow()
+        comment = Comment(thread_id=thread_id, author_id=author_id,
+                          text='Comment %s' % i, created=now, modified=now,
+                          parent_id=parent_id if i % depth else None)
+        db.session.add(comment)
+        db.session.flush()
+        parent_id = comment.id
+        ids.append(comment.id)
+    db.session.commit()
+    return ids
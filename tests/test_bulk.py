@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+from tagarela import bulk
+from tagarela.models import Comment, Thread, Author, get_id_add_if_needed
+from tagarela.extensions import db
+from helpers import AppTestCase, add_thread
+
+
+class ImportExportTest(AppTestCase):
+    '''Imported comments get a new range of ids, with the same structure.'''
+
+    def test_round_trip(self):
+        ids = add_thread('thread', 3, 3)
+        comment = db.session.query(Comment).get(ids[-1])
+        comment.set_vote(get_id_add_if_needed(Author, 'voter'), True)
+        db.session.commit()
+
+        records = list(bulk.export_records())
+        max_id = bulk.max_comment_id(records)
+        self.assertEqual(max_id, ids[-1])
+        self.assertEqual(bulk.import_records(records, max_id), (3, 1))
+
+        db.session.expire_all()
+        comments = db.session.query(Comment).order_by(Comment.id).all()
+        self.assertEqual([c.id for c in comments],
+                         ids + [i + max_id for i in ids])
+        old, new = comments[:3], comments[3:]
+        for before, after in zip(old, new):
+            self.assertEqual(after.text, before.text)
+            self.assertEqual(after.parent_id,
+                             before.parent_id and before.parent_id + max_id)
+            self.assertEqual(after.likes, before.likes)
+        thread = db.session.query(Thread).filter_by(name='thread').one()
+        self.assertEqual(thread.comment_count, 6)
+
+    def test_reserved_ids_follow_the_greatest_id(self):
+        ids = add_thread('thread', 2, 1)
+        self.assertEqual(bulk.reserve_comment_ids(10), ids[-1])
+
+    def test_import_leaves_other_threads_alone(self):
+        add_thread('other', 2, 1)
+        other = db.session.query(Thread).filter_by(name='other').one()
+        version = other.version
+        records = [
+            {'type': 'comment', 'id': 1, 'thread': 'new', 'author': 'a',
+             'text': 'Root', 'created': '2015-01-01T00:00:00+00:00'},
+            {'type': 'comment', 'id': 2, 'thread': 'new', 'author': 'b',
+             'text': 'Reply', 'created': '2015-01-02T00:00:00+00:00',
+             'parent_id': 1},
+            {'type': 'vote', 'comment_id': 2, 'author': 'a', 'like': False},
+        ]
+        bulk.import_records(records, 2, batch_size=1)
+
+        db.session.expire_all()
+        self.assertEqual(db.session.query(Thread).get(other.id).version,
+                         version)
+        new = db.session.query(Thread).filter_by(name='new').one()
+        self.assertEqual(new.comment_count, 2)
+        reply = db.session.query(Comment).filter_by(text='Reply').one()
+        self.assertEqual(reply.dislikes, 1)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+from tagarela.models import Comment, Author, get_id_add_if_needed
+from tagarela.extensions import db
+from helpers import AppTestCase, add_thread
+
+
+class ConditionalRequestsTest(AppTestCase):
+    '''ETags change whenever the representation changes.'''
+
+    def get(self, url, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get(url, headers=headers)
+
+    def vote(self, comment_id, author_name, like):
+        comment = db.session.query(Comment).get(comment_id)
+        comment.set_vote(get_id_add_if_needed(Author, author_name), like)
+        db.session.commit()
+
+    def test_thread_etag_changes_with_votes_that_cancel_out(self):
+        comment_id, = add_thread('thread', 1, 1)
+        self.vote(comment_id, 'a', True)
+        self.vote(comment_id, 'b', False)
+        etag = self.get('/thread/thread').headers['ETag']
+        self.assertEqual(self.get('/thread/thread', etag).status_code, 304)
+
+        self.vote(comment_id, 'a', False)
+        self.vote(comment_id, 'b', True)
+        response = self.get('/thread/thread', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_thread_ignores_if_modified_since(self):
+        comment_id, = add_thread('thread', 1, 1)
+        response = self.get('/thread/thread')
+        self.assertNotIn('Last-Modified', response.headers)
+        self.vote(comment_id, 'a', True)
+        response = self.client.get('/thread/thread', headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_thread_etag_varies_by_stream(self):
+        add_thread('thread', 2, 2)
+        etag = self.get('/thread/thread').headers['ETag']
+        response = self.get('/thread/thread?stream=true', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_comment_list_etag(self):
+        add_thread('thread', 3, 1)
+        etag = self.get('/comment').headers['ETag']
+        self.assertEqual(self.get('/comment', etag).status_code, 304)
+        add_thread('thread', 1, 1)
+        self.assertEqual(self.get('/comment', etag).status_code, 200)
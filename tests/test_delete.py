@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import json
+
+from tagarela.models import Comment, Thread, delete_comments
+from tagarela.extensions import db
+from helpers import AppTestCase, add_thread
+
+
+class DeleteTest(AppTestCase):
+    '''Comments with replies are hidden, the others deleted along with their
+    hidden ancestors left without replies.'''
+
+    def delete(self, comment_id):
+        response = self.client.delete(
+            '/comment/%s' % comment_id, content_type='application/json',
+            data=json.dumps({'token': 'author', 'response': 'delta'}))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode('utf-8'))
+
+    def remaining(self):
+        db.session.expire_all()
+        return [(c.id, c.hidden) for c in
+                db.session.query(Comment).order_by(Comment.id)]
+
+    def comment_count(self):
+        return db.session.query(Thread.comment_count).scalar()
+
+    def test_delete_root(self):
+        root, other = add_thread('thread', 2, 1)
+        result = self.delete(root)
+        self.assertEqual(result['comments'],
+                         [{'id': root, 'deleted': True}])
+        self.assertEqual(self.remaining(), [(other, False)])
+        self.assertEqual(self.comment_count(), 1)
+
+    def test_delete_reply_of_visible_parent(self):
+        root, reply = add_thread('thread', 2, 2)
+        self.delete(reply)
+        self.assertEqual(self.remaining(), [(root, False)])
+
+    def test_hide_comment_with_replies(self):
+        root, reply = add_thread('thread', 2, 2)
+        self.delete(root)
+        self.assertEqual(self.remaining(), [(root, True), (reply, False)])
+
+    def test_delete_hidden_chain(self):
+        root, reply, last = add_thread('thread', 3, 3)
+        self.delete(root)
+        self.delete(reply)
+        self.assertEqual(self.remaining(),
+                         [(root, True), (reply, True), (last, False)])
+        self.delete(last)
+        self.assertEqual(self.remaining(), [])
+        self.assertEqual(self.comment_count(), 0)
+
+    def test_delete_many(self):
+        first = add_thread('thread', 3, 3)
+        second = add_thread('thread', 2, 2)
+        delete_comments([first[0], first[1]])
+        db.session.commit()
+        # Deleting all the replies of a hidden chain deletes it too
+        deleted = delete_comments([first[2], second[1]])
+        db.session.commit()
+        self.assertEqual(sorted(deleted), sorted(first + second[1:]))
+        self.assertEqual(self.remaining(), [(second[0], False)])
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import json
+import unittest
+
+from tagarela import views
+from tagarela.models import Thread
+from tagarela.events import events, LocalBroker
+from tagarela.extensions import db
+from helpers import AppTestCase, add_thread
+
+
+class EventsTest(AppTestCase):
+    '''Event ids are the versions of the threads in the DB, so they are
+    shared by every process, with or without a thread cache.'''
+
+    settings = {'EVENTS_BACKEND': 'local', 'THREAD_CACHE_BACKEND': None}
+
+    def thread_version(self, name):
+        db.session.expire_all()
+        return (db.session.query(Thread.version)
+                .filter_by(name=name).scalar())
+
+    def post(self, url, data):
+        response = self.client.post(url, content_type='application/json',
+                                    data=json.dumps(data))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data.decode('utf-8'))
+
+    def test_event_ids_are_thread_versions(self):
+        comment_id, = add_thread('thread', 1, 1)
+        subscription = events.subscribe('thread')
+        try:
+            result = self.post('/comment/%s' % comment_id, {
+                'token': 'alice', 'text': 'Reply', 'response': 'delta'})
+            message = subscription.get(1)
+            self.assertEqual(message['event'], 'comment')
+            self.assertEqual(message['id'], self.thread_version('thread'))
+            self.assertEqual(result['version'], message['id'])
+
+            self.post('/vote/%s' % comment_id, {
+                'token': 'bob', 'vote': True, 'response': 'minimal'})
+            vote = subscription.get(1)
+            self.assertEqual(vote['event'], 'votes')
+            self.assertEqual(vote['id'], self.thread_version('thread'))
+            self.assertGreater(vote['id'], message['id'])
+        finally:
+            subscription.close()
+
+    def test_stale_last_event_id_gets_reset(self):
+        add_thread('thread', 2, 1)
+        version = self.thread_version('thread')
+
+        stream = views.stream_events('thread', str(version))
+        self.assertEqual(next(stream), ': connected\n\n')
+        stream.close()
+
+        stream = views.stream_events('thread', str(version - 1))
+        self.assertIn('event: reset', next(stream))
+        stream.close()
+
+
+class DisabledEventsTest(AppTestCase):
+
+    def test_disabled_by_default(self):
+        self.assertFalse(events.enabled)
+        response = self.client.get('/thread/thread/events')
+        self.assertEqual(response.status_code, 404)
+
+
+class LocalBrokerTest(unittest.TestCase):
+
+    def test_fan_out_and_overflow(self):
+        broker = LocalBroker(queue_size=2)
+        fast = broker.subscribe('thread')
+        slow = broker.subscribe('thread')
+        for i in range(1, 5):
+            broker.publish('thread', {'event': 'votes', 'id': i})
+            self.assertEqual(fast.get(0)['id'], i)
+        # The slow subscriber missed messages: they are dropped
+        self.assertEqual(slow.get(0)['event'], 'reset')
+        self.assertIsNone(slow.get(0))
+        fast.close()
+        slow.close()
+        self.assertEqual(broker.channels, {})
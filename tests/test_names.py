@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import json
+
+from tagarela.models import Thread, Author, name_ids, get_id_add_if_needed
+from tagarela.extensions import db
+from helpers import AppTestCase
+
+
+class NamesTest(AppTestCase):
+    '''Authors and threads are added in the transaction of the request.'''
+
+    def test_post_to_new_thread(self):
+        response = self.client.post(
+            '/thread/new', content_type='application/json',
+            data=json.dumps({'token': 'alice', 'text': 'First!'}))
+        self.assertEqual(response.status_code, 200)
+        thread = db.session.query(Thread).filter_by(name='new').one()
+        author = db.session.query(Author).filter_by(name='alice').one()
+        self.assertEqual([c.author_id for c in thread.comments], [author.id])
+
+    def test_rollback_discards_new_names(self):
+        get_id_add_if_needed(Author, 'bob')
+        db.session.rollback()
+        self.assertEqual(
+            db.session.query(Author).filter_by(name='bob').count(), 0)
+        self.assertIsNone(name_ids['author'].get('bob'))
+
+    def test_existing_names_are_cached(self):
+        author_id = get_id_add_if_needed(Author, 'carol')
+        db.session.commit()
+        self.assertEqual(get_id_add_if_needed(Author, 'carol'), author_id)
+        self.assertEqual(name_ids['author'].get('carol'), author_id)
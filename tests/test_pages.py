@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import json
+
+import arrow
+
+from tagarela.models import Comment, Author, get_id_add_if_needed
+from tagarela.cutils import encode_cursor
+from tagarela.extensions import db
+from helpers import AppTestCase, add_thread
+
+
+class PagesTestCase(AppTestCase):
+
+    def get(self, url, status=200):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.data.decode('utf-8'))
+
+
+class CommentListPagesTest(PagesTestCase):
+    '''Pages of the list of comments, with cursors.'''
+
+    def test_comment_list_cursor(self):
+        ids = add_thread('thread', 5, 1)
+        for sort, expected in (('newest', ids[::-1]), ('oldest', ids)):
+            page = self.get('/comment?sort=%s&per_page_num=2' % sort)
+            seen = [c['id'] for c in page['comments']]
+            while page['next']:
+                page = self.get('/comment?per_page_num=2&cursor=%s' %
+                                page['next'])
+                seen.extend(c['id'] for c in page['comments'])
+            self.assertEqual(seen, expected)
+
+    def test_tampered_cursors(self):
+        add_thread('thread', 3, 1)
+        list_cursors = [
+            'not base64!',
+            encode_cursor(['newest'], ['2015-01-01T00:00:00', 1]),
+            encode_cursor('newest', ['not a date', 1]),
+            encode_cursor('newest', ['2015-01-01T00:00:00', 'x']),
+            encode_cursor('top', ['high', 1]),
+            encode_cursor('newest'),
+        ]
+        for cursor in list_cursors:
+            self.get('/comment?cursor=%s' % cursor, 400)
+        thread_cursors = [
+            encode_cursor(None, {}, None),
+            encode_cursor(None, 'oldest', ['not a date', 1]),
+            encode_cursor('x', 'oldest', None),
+            encode_cursor(None, 'oldest'),
+        ]
+        for cursor in thread_cursors:
+            self.get('/thread/thread?cursor=%s' % cursor, 400)
+
+
+def add_replies(parent_id, size):
+    '''Add size replies to a comment. Returns their ids.'''
+    parent = db.session.query(Comment).get(parent_id)
+    author_id = get_id_add_if_needed(Author, 'author')
+    ids = []
+    for i in range(size):
+        now = arrow.utcnow()
+        comment = Comment(thread_id=parent.thread_id, author_id=author_id,
+                          text='Reply %s' % i, created=now, modified=now,
+                          parent_id=parent_id)
+        db.session.add(comment)
+        db.session.flush()
+        ids.append(comment.id)
+    db.session.commit()
+    return ids
+
+
+class ThreadPagesTest(PagesTestCase):
+    '''Pages of a thread collapse replies, which can be fetched with their
+    "replies_cursor".'''
+
+    def test_more_replies(self):
+        root, = add_thread('thread', 1, 1)
+        replies = add_replies(root, 5)
+        page = self.get('/thread/thread?replies_limit=2')
+        node, = page['comments']
+        self.assertEqual([r['id'] for r in node['replies']], replies[:2])
+        self.assertEqual(node['more_replies'], 3)
+
+        page = self.get('/thread/thread?cursor=%s' % node['replies_cursor'])
+        self.assertEqual([c['id'] for c in page['comments']], replies[2:])
+        self.assertIsNone(page['next'])
+
+    def test_max_depth(self):
+        root, reply, last = add_thread('thread', 3, 3)
+        page = self.get('/thread/thread?max_depth=2')
+        node, = page['comments']
+        child, = node['replies']
+        self.assertEqual(child['id'], reply)
+        self.assertEqual(child['replies'], [])
+        self.assertEqual(child['more_replies'], 1)
+
+        page = self.get('/thread/thread?cursor=%s' %
+                        child['replies_cursor'])
+        self.assertEqual([c['id'] for c in page['comments']], [last])
+
+    def test_limits_are_capped(self):
+        self.app.config['THREAD_PAGE_MAX_LIMIT'] = 2
+        self.app.config['THREAD_PAGE_MAX_REPLIES'] = 1
+        root = add_thread('thread', 3, 1)[0]
+        add_replies(root, 3)
+        page = self.get('/thread/thread?limit=1000&replies_limit=1000')
+        self.assertEqual(len(page['comments']), 2)
+        self.assertIsNotNone(page['next'])
+        node = page['comments'][0]
+        self.assertEqual(len(node['replies']), 1)
+        self.assertEqual(node['more_replies'], 2)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+from tagarela.models import Report
+from tagarela.outbox import outbox
+from tagarela.extensions import db
+from helpers import AppTestCase, add_thread
+
+
+class ReportsTest(AppTestCase):
+    '''Reports of a comment are joined only while they can still be
+    sent.'''
+
+    def add(self, comment_id):
+        Report.add(comment_id, 'http://localhost/delete', 0,
+                   outbox.max_attempts)
+        db.session.commit()
+        return db.session.query(Report).order_by(Report.id).all()
+
+    def test_reports_are_joined(self):
+        comment_id, = add_thread('thread', 1, 1)
+        self.add(comment_id)
+        reports = self.add(comment_id)
+        self.assertEqual([r.reports for r in reports], [2])
+
+    def test_reports_given_up_are_not_joined(self):
+        comment_id, = add_thread('thread', 1, 1)
+        report, = self.add(comment_id)
+        report.attempts = outbox.max_attempts
+        db.session.commit()
+        reports = self.add(comment_id)
+        self.assertEqual([r.reports for r in reports], [1, 1])
+
+    def test_claimed_reports_are_not_joined(self):
+        comment_id, = add_thread('thread', 1, 1)
+        report, = self.add(comment_id)
+        self.assertTrue(outbox.claim(report.id))
+        # Leased: no other worker takes it
+        self.assertFalse(outbox.claim(report.id))
+        reports = self.add(comment_id)
+        self.assertEqual([r.reports for r in reports], [1, 1])
+
+    def test_sent_reports(self):
+        comment_id, = add_thread('thread', 1, 1)
+        self.add(comment_id)
+        self.assertEqual(outbox.send_due(), 1)
+        report, = db.session.query(Report).all()
+        self.assertIsNotNone(report.sent)
+        self.assertIsNone(report.claimed_until)
+        self.assertEqual(outbox.send_due(), 0)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import json
+
+from tagarela.models import Comment, Author, get_id_add_if_needed
+from tagarela.extensions import db
+from helpers import AppTestCase, add_thread
+
+
+class ScoresTest(AppTestCase):
+    '''Scores follow the votes and rank the comments of sort=top.'''
+
+    def vote(self, comment_id, author_name, like):
+        comment = db.session.query(Comment).get(comment_id)
+        comment.set_vote(get_id_add_if_needed(Author, author_name), like)
+        db.session.commit()
+
+    def score(self, comment_id):
+        db.session.expire_all()
+        return db.session.query(Comment).get(comment_id).score
+
+    def test_votes_update_the_score(self):
+        comment_id, = add_thread('thread', 1, 1)
+        self.assertEqual(self.score(comment_id), 0)
+        self.vote(comment_id, 'a', True)
+        liked = self.score(comment_id)
+        self.assertGreater(liked, 0)
+        self.vote(comment_id, 'a', False)
+        self.assertLess(self.score(comment_id), liked)
+
+    def test_top_sort(self):
+        disliked, best, liked = add_thread('thread', 3, 1)
+        self.vote(disliked, 'a', False)
+        for name in 'abc':
+            self.vote(best, name, True)
+        self.vote(liked, 'a', True)
+        response = self.client.get('/comment?sort=top')
+        ids = [c['id'] for c in json.loads(response.data.decode('utf-8'))
+               ['comments']]
+        self.assertEqual(ids, [best, liked, disliked])
+
+    def test_top_etag_changes_with_scores(self):
+        best, other = add_thread('thread', 2, 1)
+        self.vote(best, 'a', True)
+        url = '/comment?sort=top&per_page_num=1'
+        etag = self.client.get(url).headers['ETag']
+        self.vote(best, 'b', True)
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
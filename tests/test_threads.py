@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+
+from sqlalchemy import event
+
+from tagarela import views
+from tagarela.extensions import db
+from helpers import AppTestCase, add_thread
+
+
+class ThreadQueriesTest(AppTestCase):
+    '''Serializing a thread takes the same queries whatever its size.'''
+
+    def count_selects(self, thread_name):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with self.app.test_request_context():
+                payload = views.get_thread_comments(thread_name=thread_name)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        selects = [s for s in statements
+                   if s.lstrip().upper().startswith('SELECT')]
+        return len(selects), payload
+
+    def test_queries_dont_grow_with_thread(self):
+        add_thread('small', 3, 2)
+        add_thread('large', 200, 10)
+        small, payload = self.count_selects('small')
+        self.assertEqual(payload['count'], 3)
+        large, payload = self.count_selects('large')
+        self.assertEqual(payload['count'], 200)
+        self.assertEqual(small, 1)
+        self.assertEqual(large, small)
+
+    def test_tree_is_nested(self):
+        ids = add_thread('nested', 4, 4)
+        count, payload = self.count_selects('nested')
+        node = payload['comments'][0]
+        for comment_id in ids[:-1]:
+            self.assertEqual(node['id'], comment_id)
+            self.assertEqual(len(node['replies']), 1)
+            node = node['replies'][0]
+        self.assertEqual(node['id'], ids[-1])
+        self.assertEqual(node['replies'], [])
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import unicode_literals  # unicode by default
+import threading
+
+import arrow
+from sqlalchemy import event
+
+from tagarela.models import (Comment, Thread, Author, Vote,
+                             get_id_add_if_needed)
+from tagarela.extensions import db, writing
+from helpers import AppTestCase, add_thread
+
+
+class ConcurrentVotesTest(AppTestCase):
+    '''Votes of many threads at once must keep the counters of the comment
+    consistent with the votes table.'''
+
+    voters = 8
+    votes_per_voter = 20
+
+    def test_counters_match_votes(self):
+        thread_id = get_id_add_if_needed(Thread, 'thread')
+        author_ids = [get_id_add_if_needed(Author, 'author%s' % i)
+                      for i in range(self.voters + 1)]
+        now = arrow.utcnow()
+        comment = Comment(thread_id=thread_id, author_id=author_ids[0],
+                          text='Comment', created=now, modified=now)
+        db.session.add(comment)
+        db.session.commit()
+        comment_id = comment.id
+        # Don't hold a read lock of SQLite while the voters write
+        db.session.remove()
+        errors = []
+
+        def vote(author_id):
+            # Like the requests that vote
+            with self.app.app_context(), writing():
+                try:
+                    # Likes and dislikes, so votes are added and changed
+                    for i in range(self.votes_per_voter):
+                        comment = db.session.query(Comment).get(comment_id)
+                        comment.set_vote(author_id, i % 3 != 0)
+                        db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=vote, args=(author_id,))
+                   for author_id in author_ids[1:]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        db.session.expire_all()
+        comment = db.session.query(Comment).get(comment_id)
+        votes = db.session.query(Vote).filter_by(comment_id=comment_id)
+        self.assertEqual(votes.count(), self.voters)
+        self.assertEqual(comment.likes + comment.dislikes, votes.count())
+        self.assertEqual(comment.likes, votes.filter_by(like=True).count())
+        # The last vote of each voter is a like
+        self.assertEqual(comment.likes, self.voters)
+
+
+class VoteStatementsTest(AppTestCase):
+    '''On Postgres, a vote changes the vote, the counters and score of the
+    comment and the version of its thread in a single statement.'''
+
+    def test_one_statement_on_postgres(self):
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest('The upsert needs Postgres')
+        comment_id, = add_thread('thread', 1, 1)
+        author_id = get_id_add_if_needed(Author, 'voter')
+        version = db.session.query(Thread.version).scalar()
+        comment = db.session.query(Comment).get(comment_id)
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            comment.set_vote(author_id, True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        db.session.commit()
+        self.assertEqual(len(statements), 1)
+
+        comment = db.session.query(Comment).get(comment_id)
+        self.assertEqual(comment.likes, 1)
+        self.assertGreater(comment.score, 0)
+        self.assertEqual(db.session.query(Thread.version).scalar(),
+                         version + 1)